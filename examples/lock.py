@@ -24,7 +24,8 @@ class LockObserver(object):
 ZOOKEEPER_SERVER='localhost:2181'
 def main():
     # As a lock is per connection, we need to create a connection
-    # per lock.
+    # per lock. Use zkpy.lock.LockManager to share a lock between the
+    # threads of a process.
     conn1 = Connection(ZOOKEEPER_SERVER, 3)
     conn2 = Connection(ZOOKEEPER_SERVER, 3)
 
@@ -0,0 +1,64 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+
+Tests of zkpy and its recipes. They run against zkpy.testing.FakeZookeeper,
+thus neither a zookeeper ensemble nor the C binding is needed:
+
+    python -m unittest discover -s tests -t .
+'''
+
+from zkpy.testing import FakeZookeeper, install
+import time
+import unittest
+
+try:
+    import zookeeper
+except ImportError:
+    # the recipes import the zookeeper module: register the fake instead
+    zookeeper = install()
+
+from zkpy.acl import Acls
+from zkpy.connection import Connection
+
+
+class FakeTestCase(unittest.TestCase):
+    '''Test running against a FakeZookeeper of its own. The connections
+    opened by connect() are closed after the test.
+    '''
+
+    latency = 0.001
+
+    def setUp(self):
+        self.fake = FakeZookeeper(latency=self.latency)
+        self._connections = []
+        self.conn = self.connect()
+
+    def tearDown(self):
+        for conn in self._connections:
+            try:
+                conn.close()
+            except zookeeper.ZooKeeperException:
+                pass
+
+    def connect(self, **kwargs):
+        '''Opens a connection to the fake'''
+        conn = Connection('fake', 5, backend=self.fake, **kwargs)
+        self._connections.append(conn)
+        return conn
+
+    def create(self, *paths):
+        '''Creates the given nodes and their parents'''
+        self.conn.ensure_tree(paths, '', [Acls.Unsafe])
+
+    def wait_until(self, condition, timeout = 2):
+        '''Waits until condition() returns True. Returns False, if the
+        timeout passed before.
+        '''
+        until = time.time() + timeout
+        while not condition():
+            if time.time() >= until:
+                return False
+            time.sleep(0.005)
+        return True
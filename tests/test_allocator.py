@@ -0,0 +1,36 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.allocator import IdAllocator
+import threading
+
+
+class IdAllocatorTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/ids')
+
+    def test_block(self):
+        allocator = IdAllocator(self.conn, '/ids', block_size=10)
+        self.assertEqual([allocator.next_id() for _ in range(25)], range(25))
+        self.assertEqual(allocator.reservations, 3)
+
+    def test_unique(self):
+        allocators = [IdAllocator(self.connect(), '/ids', block_size=7)
+                      for _ in range(4)]
+        ids = []
+        def allocate(allocator):
+            for _ in range(50):
+                ids.append(allocator.next_id())
+        threads = [threading.Thread(target=allocate, args=(allocator,))
+                   for allocator in allocators]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(ids)), 200)
@@ -0,0 +1,97 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.acl import Acls
+from zkpy.barrier import Barrier, DoubleBarrier
+import threading
+import zookeeper
+
+
+class BarrierTest(FakeTestCase):
+
+    def test_wait(self):
+        self.create('/barriers')
+        barrier = Barrier(self.conn, '/barriers/gate')
+        barrier.set_barrier()
+        passed = []
+        waiters = [threading.Thread(target=lambda conn=conn: passed.append(
+                                            Barrier(conn, '/barriers/gate').wait(5)))
+                   for conn in [self.connect() for _ in range(5)]]
+        for waiter in waiters:
+            waiter.start()
+        self.assertFalse(self.wait_until(lambda: passed, 0.1))
+        barrier.remove_barrier()
+        for waiter in waiters:
+            waiter.join(5)
+        self.assertEqual(passed, [True] * 5)
+
+    def test_timeout(self):
+        barrier = Barrier(self.conn, '/gate')
+        barrier.set_barrier()
+        self.assertFalse(barrier.wait(0.1))
+        barrier.remove_barrier()
+        self.assertTrue(barrier.wait(0.1))
+
+    def test_session_expiry(self):
+        Barrier(self.conn, '/gate').set_barrier()
+        other = self.connect()
+        raised = []
+        def wait():
+            try:
+                Barrier(other, '/gate').wait()
+            except zookeeper.SessionExpiredException as e:
+                raised.append(e)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        self.wait_until(lambda: self.fake.counters.get('exists', 0) >= 1)
+        self.fake.expire_session(other.handle)
+        waiter.join(2)
+        self.assertEqual(len(raised), 1)
+
+
+class DoubleBarrierTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/double')
+
+    def test_enter_and_leave(self):
+        count = 5
+        events = []
+        lock = threading.Lock()
+        def participate(conn):
+            barrier = DoubleBarrier(conn, '/double', count)
+            for round in range(2):
+                self.assertTrue(barrier.enter(5))
+                with lock:
+                    events.append(('enter', round))
+                self.assertTrue(barrier.leave(5))
+                with lock:
+                    events.append(('leave', round))
+        participants = [threading.Thread(target=participate, args=(self.connect(),))
+                        for _ in range(count)]
+        for participant in participants:
+            participant.start()
+        for participant in participants:
+            participant.join(10)
+        self.assertEqual(len(events), 4 * count)
+        # nobody leaves a round, before all entered it
+        for round in range(2):
+            last_enter = max(index for index, event in enumerate(events)
+                             if event == ('enter', round))
+            self.assertTrue(last_enter < events.index(('leave', round)))
+        self.assertEqual(self.conn.get_children('/double'), [])
+
+    def test_ready_node_is_no_participant(self):
+        self.conn.create('/double/ready', '', [Acls.Unsafe], 0)
+        barrier = DoubleBarrier(self.conn, '/double', 2)
+        self.assertEqual(barrier._participants(), (0, True))
+
+    def test_enter_timeout(self):
+        barrier = DoubleBarrier(self.conn, '/double', 2)
+        self.assertFalse(barrier.enter(0.1))
+        self.assertEqual(self.conn.get_children('/double'), [])
@@ -0,0 +1,140 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.cache import NodeCache, TreeCache
+import os
+import shutil
+import tempfile
+
+
+class NodeCacheTest(FakeTestCase):
+
+    def test_hit(self):
+        self.create('/node')
+        cache = NodeCache(self.conn)
+        self.conn.set('/node', 'data')
+        self.assertEqual(cache.get('/node')[0], 'data')
+        self.assertEqual(cache.get('/node')[0], 'data')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.close()
+
+    def test_invalidated_on_change(self):
+        self.create('/node')
+        cache = NodeCache(self.conn)
+        self.assertEqual(cache.get('/node')[0], '')
+        self.assertEqual(cache.get_children('/node'), [])
+        other = self.connect()
+        other.set('/node', 'changed')
+        other.create('/node/child', '', self.conn.get_acl('/node')[1])
+        self.assertTrue(self.wait_until(lambda: cache.get('/node')[0] == 'changed'))
+        self.assertTrue(self.wait_until(lambda: cache.get_children('/node') == ['child']))
+        cache.close()
+
+    def test_missing_node(self):
+        cache = NodeCache(self.conn)
+        self.assertEqual(cache.exists('/missing'), None)
+        self.assertEqual(cache.exists('/missing'), None)
+        self.create('/missing')
+        self.assertTrue(self.wait_until(lambda: cache.exists('/missing') is not None))
+        cache.close()
+
+    def test_one_watch_per_path(self):
+        self.create('/node')
+        cache = NodeCache(self.conn, max_size=1)
+        for _ in range(10):
+            # the entries evict each other
+            cache.get('/node')
+            cache.get_children('/node')
+        self.assertEqual(cache.misses, 20)
+        self.assertEqual(len(self.fake._data_watches['/node']), 1)
+        self.assertEqual(len(self.fake._child_watches['/node']), 1)
+        cache.close()
+
+
+class TreeObserver(object):
+
+    def __init__(self):
+        self.events = []
+
+    def node_added(self, path, data):
+        self.events.append(('added', path, data))
+
+    def node_updated(self, path, data):
+        self.events.append(('updated', path, data))
+
+    def node_removed(self, path):
+        self.events.append(('removed', path))
+
+
+class TreeCacheTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/tree/a/b', '/tree/c')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        FakeTestCase.tearDown(self)
+
+    def test_mirror(self):
+        cache = TreeCache(self.conn, '/tree')
+        self.assertTrue(cache.start(timeout=2))
+        self.assertEqual(sorted(cache.snapshot()),
+                         ['/tree', '/tree/a', '/tree/a/b', '/tree/c'])
+        self.assertEqual(cache.get_children('/tree'), ['a', 'c'])
+        self.assertEqual(cache.get('/missing'), None)
+        cache.close()
+
+    def test_follows_changes(self):
+        observer = TreeObserver()
+        cache = TreeCache(self.conn, '/tree', observer)
+        cache.start(timeout=2)
+        del observer.events[:]
+        other = self.connect()
+        other.set('/tree/a/b', 'data')
+        self.create('/tree/d/e')
+        other.delete('/tree/c')
+        self.assertTrue(self.wait_until(lambda: len(observer.events) == 4))
+        self.assertEqual(sorted(observer.events),
+                         [('added', '/tree/d', ''), ('added', '/tree/d/e', ''),
+                          ('removed', '/tree/c'), ('updated', '/tree/a/b', 'data')])
+        self.assertEqual(cache.get('/tree/a/b')[0], 'data')
+        self.assertEqual(cache.get_children('/tree'), ['a', 'd'])
+        cache.close()
+
+    def test_snapshot(self):
+        snapshot = os.path.join(self.directory, 'tree')
+        cache = TreeCache(self.conn, '/tree')
+        cache.start(timeout=2)
+        cache.save(snapshot)
+        cache.close()
+
+        self.conn.set('/tree/c', 'changed')
+        self.create('/tree/d')
+        cache = TreeCache(self.connect(), '/tree')
+        self.fake.counters.clear()
+        self.assertTrue(cache.start(timeout=2, snapshot=snapshot))
+        self.assertEqual(cache.get('/tree/c')[0], 'changed')
+        self.assertEqual(cache.get_children('/tree'), ['a', 'c', 'd'])
+        # only the data of the changed and the added node is read
+        self.assertEqual(self.fake.counters['get'], 2)
+        cache.close()
+
+    def test_snapshot_of_another_root_is_ignored(self):
+        self.create('/other/x')
+        snapshot = os.path.join(self.directory, 'other')
+        cache = TreeCache(self.conn, '/other')
+        cache.start(timeout=2)
+        cache.save(snapshot)
+        cache.close()
+
+        cache = TreeCache(self.conn, '/tree')
+        self.assertTrue(cache.start(timeout=2, snapshot=snapshot))
+        self.assertEqual(sorted(cache.snapshot()),
+                         ['/tree', '/tree/a', '/tree/a/b', '/tree/c'])
+        cache.close()
@@ -0,0 +1,85 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.election import LeaderElection
+
+
+class Observer(object):
+
+    def __init__(self):
+        self.events = []
+
+    def elected(self):
+        self.events.append('elected')
+
+    def deposed(self):
+        self.events.append('deposed')
+
+    def leader_changed(self, data):
+        self.events.append(('leader', data))
+
+
+class LeaderElectionTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/election')
+
+    def test_first_candidate_leads(self):
+        observer = Observer()
+        first = LeaderElection(self.connect(), '/election', 'first', observer)
+        second = LeaderElection(self.connect(), '/election', 'second')
+        self.assertTrue(first.join())
+        self.assertFalse(second.join())
+        self.assertTrue(first.is_leader())
+        self.assertFalse(second.is_leader())
+        self.assertEqual(observer.events, ['elected'])
+        self.assertEqual(second.leader, 'first')
+
+    def test_failover(self):
+        observer = Observer()
+        first = LeaderElection(self.connect(), '/election', 'first')
+        second = LeaderElection(self.connect(), '/election', 'second', observer)
+        first.join()
+        second.join()
+        first.resign()
+        self.assertTrue(self.wait_until(second.is_leader))
+        self.assertEqual(second.leader, 'second')
+        self.assertEqual(observer.events, ['elected'])
+
+    def test_follower(self):
+        observer = Observer()
+        follower = LeaderElection(self.connect(), '/election', observer=observer,
+                                  follow=True)
+        candidates = [LeaderElection(self.connect(), '/election', str(index))
+                      for index in range(3)]
+        for candidate in candidates:
+            candidate.join()
+        self.assertTrue(self.wait_until(lambda: follower.leader == '0'))
+        candidates[0].resign()
+        self.assertTrue(self.wait_until(lambda: follower.leader == '1'))
+        self.assertTrue(follower.handover_time is not None)
+        self.assertEqual(observer.events[-1], ('leader', '1'))
+        follower.close()
+
+    def test_only_followers_watch_the_leader(self):
+        candidates = [LeaderElection(self.connect(), '/election', str(index))
+                      for index in range(5)]
+        for candidate in candidates:
+            candidate.join()
+        self.assertFalse('/election/leader' in self.fake._data_watches)
+
+    def test_expiry_deposes(self):
+        observer = Observer()
+        conn = self.connect()
+        first = LeaderElection(conn, '/election', 'first', observer)
+        second = LeaderElection(self.connect(), '/election', 'second')
+        first.join()
+        second.join()
+        self.fake.expire_session(conn.handle)
+        self.assertTrue(self.wait_until(second.is_leader))
+        self.assertEqual(observer.events, ['elected', 'deposed'])
@@ -0,0 +1,101 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.lock import Lock, LockManager, MultiLock, ReadWriteLock
+import threading
+
+
+class LockTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/lock', '/other')
+
+    def test_exclusive(self):
+        first, second = Lock(self.conn, '/lock'), Lock(self.connect(), '/lock')
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertTrue(first.is_owner())
+        self.assertFalse(second.is_owner())
+
+    def test_handover(self):
+        first, second = Lock(self.conn, '/lock'), Lock(self.connect(), '/lock')
+        first.acquire()
+        self.assertFalse(second.acquire())
+        first.release()
+        self.assertTrue(self.wait_until(second.is_owner))
+
+    def test_timeout(self):
+        first, second = Lock(self.conn, '/lock'), Lock(self.connect(), '/lock')
+        first.acquire()
+        self.assertFalse(second.acquire(True, 0.1))
+        # the timed out lock left the queue
+        self.assertEqual(len(self.conn.get_children('/lock')), 1)
+
+    def test_blocking_waiters_in_order(self):
+        holder = Lock(self.conn, '/lock')
+        holder.acquire()
+        acquired = []
+        def wait(index, lock):
+            lock.acquire(True, 5)
+            acquired.append(index)
+            lock.release()
+        waiters = []
+        for index in range(5):
+            lock = Lock(self.connect(), '/lock')
+            lock.acquire()
+            waiters.append(threading.Thread(target=wait, args=(index, lock)))
+        for waiter in waiters:
+            waiter.start()
+        holder.release()
+        for waiter in waiters:
+            waiter.join(5)
+        self.assertEqual(acquired, range(5))
+
+    def test_expiry_releases(self):
+        other = self.connect()
+        first, second = Lock(other, '/lock'), Lock(self.conn, '/lock')
+        first.acquire()
+        second.acquire()
+        self.fake.expire_session(other.handle)
+        self.assertTrue(self.wait_until(second.is_owner))
+
+    def test_multi_lock(self):
+        first = MultiLock(self.conn, ['/lock', '/other'])
+        second = MultiLock(self.connect(), ['/other', '/lock'])
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire(True, 0.1))
+        self.assertFalse(second.acquire(True, 0))
+        first.release()
+        self.assertTrue(second.acquire(True, 2))
+
+    def test_read_write_lock(self):
+        first, second = ReadWriteLock(self.conn, '/lock'), ReadWriteLock(self.connect(), '/lock')
+        self.assertTrue(first.read_lock.acquire())
+        self.assertTrue(second.read_lock.acquire())
+        writer = ReadWriteLock(self.connect(), '/lock').write_lock
+        self.assertFalse(writer.acquire())
+        first.read_lock.release()
+        second.read_lock.release()
+        self.assertTrue(self.wait_until(writer.is_owner))
+
+    def test_lock_manager(self):
+        manager = LockManager(self.conn)
+        held = []
+        def work(index):
+            lock = manager.lock('/lock')
+            with lock:
+                held.append(index)
+                self.assertEqual(len(held), 1)
+                held.remove(index)
+        workers = [threading.Thread(target=work, args=(index,)) for index in range(5)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(5)
+        self.assertEqual(len(manager), 0)
+        self.assertEqual(self.conn.get_children('/lock'), [])
@@ -0,0 +1,193 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.queue import Queue, PriorityQueue, DelayedQueue, ShardedQueue
+import threading
+import time
+
+
+class QueueTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/queue')
+
+    def test_fifo(self):
+        queue = Queue(self.conn, '/queue')
+        for data in ('a', 'b', 'c'):
+            queue.push(data)
+        self.assertEqual(len(queue), 3)
+        self.assertEqual([queue.pop() for _ in range(3)], ['a', 'b', 'c'])
+        self.assertRaises(IndexError, queue.pop)
+        self.assertTrue(queue.is_empty())
+
+    def test_push_many(self):
+        queue = Queue(self.conn, '/queue')
+        futures = queue.push_many([str(index) for index in range(50)], window=8)
+        self.assertEqual([future.exception() for future in futures], [None] * 50)
+        self.assertEqual(list(queue.consume(prefetch=10)),
+                         [str(index) for index in range(50)])
+
+    def test_consume_stopped_early_keeps_the_rest(self):
+        queue = Queue(self.conn, '/queue')
+        queue.push_many(['a', 'b', 'c', 'd', 'e'])
+        consumed = []
+        for data in queue.consume(prefetch=3):
+            consumed.append(data)
+            if len(consumed) == 2:
+                break
+        self.assertEqual(consumed, ['a', 'b'])
+        self.assertEqual([queue.pop() for _ in range(3)], ['c', 'd', 'e'])
+
+    def test_competing_consumers(self):
+        queues = [Queue(self.connect(), '/queue') for _ in range(3)]
+        queues[0].push_many([str(index) for index in range(30)])
+        popped = []
+        def consume(queue):
+            while True:
+                try:
+                    popped.append(queue.pop())
+                except IndexError:
+                    return
+        threads = [threading.Thread(target=consume, args=(queue,)) for queue in queues]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(popped), sorted(str(index) for index in range(30)))
+
+    def test_pop_blocking(self):
+        queue = Queue(self.conn, '/queue')
+        producer = Queue(self.connect(), '/queue')
+        timer = threading.Timer(0.1, producer.push, ('a',))
+        timer.start()
+        self.assertEqual(queue.pop_blocking(timeout=2), 'a')
+        timer.join()
+        self.assertRaises(RuntimeError, queue.pop_blocking, 0.1)
+
+    def test_blocked_consumers_share_a_watch(self):
+        queue = Queue(self.conn, '/queue')
+        producer = Queue(self.connect(), '/queue')
+        popped = []
+        threads = [threading.Thread(target=lambda: popped.append(queue.pop_blocking(timeout=2)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        self.assertEqual(len(self.fake._child_watches['/queue']), 1)
+        producer.push_many(['a', 'b', 'c', 'd', 'e'])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(popped), ['a', 'b', 'c', 'd', 'e'])
+
+
+class PriorityQueueTest(FakeTestCase):
+
+    def test_order(self):
+        self.create('/queue')
+        queue = PriorityQueue(self.conn, '/queue')
+        queue.push('low', 900)
+        queue.push('default')
+        queue.push('high', 1)
+        queue.push('default2')
+        self.assertEqual([queue.pop() for _ in range(4)],
+                         ['high', 'default', 'default2', 'low'])
+        self.assertRaises(ValueError, queue.push, 'invalid', 1000)
+
+
+class DelayedQueueTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/queue')
+
+    def test_not_ready_before_due(self):
+        queue = DelayedQueue(self.conn, '/queue')
+        queue.push('later', delay=0.3)
+        queue.push('now')
+        self.assertEqual(queue.pop(), 'now')
+        self.assertRaises(IndexError, queue.pop)
+        self.assertEqual(queue.pop_blocking(timeout=2), 'later')
+
+    def _pop_blocking_with_earlier_push(self, timeout):
+        '''A waiter blocked on a far due item needs to wake up for a new item,
+        which gets ready earlier.
+        '''
+        queue = DelayedQueue(self.conn, '/queue')
+        producer = DelayedQueue(self.connect(), '/queue')
+        producer.push('late', delay=10)
+        popped = []
+        consumer = threading.Thread(target=lambda: popped.append(queue.pop_blocking(timeout)))
+        consumer.setDaemon(True)
+        start = time.time()
+        consumer.start()
+        time.sleep(0.2)
+        producer.push('early', delay=0.3)
+        consumer.join(3)
+        self.assertEqual(popped, ['early'])
+        self.assertTrue(time.time() - start < 1.5)
+
+    def test_earlier_push_wakes_waiter_with_timeout(self):
+        self._pop_blocking_with_earlier_push(5)
+
+    def test_earlier_push_wakes_waiter_without_timeout(self):
+        self._pop_blocking_with_earlier_push(None)
+
+    def test_earlier_push_wakes_empty_queue_waiter(self):
+        queue = DelayedQueue(self.conn, '/queue')
+        producer = DelayedQueue(self.connect(), '/queue')
+        timer = threading.Timer(0.2, producer.push, ('early',), {'delay' : 0.3})
+        start = time.time()
+        timer.start()
+        self.assertEqual(queue.pop_blocking(timeout=5), 'early')
+        self.assertTrue(time.time() - start < 1.5)
+        timer.join()
+
+
+class ShardedQueueTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/queue')
+
+    def test_push_pop(self):
+        queue = ShardedQueue(self.conn, '/queue', 4, home=0)
+        for index in range(8):
+            queue.push(str(index))
+        self.assertEqual(len(self.conn.get_children('/queue')), 4)
+        self.assertEqual(sorted(queue.pop() for _ in range(8)),
+                         [str(index) for index in range(8)])
+        self.assertRaises(IndexError, queue.pop)
+        self.assertTrue(queue.is_empty())
+
+    def test_pop_blocking(self):
+        queue = ShardedQueue(self.conn, '/queue', 4)
+        producer = ShardedQueue(self.connect(), '/queue', 4)
+        popped = []
+        threads = [threading.Thread(target=lambda: popped.append(queue.pop_blocking(timeout=2)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        for index in range(4):
+            producer.push(str(index))
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(popped), ['0', '1', '2', '3'])
+        self.assertRaises(RuntimeError, queue.pop_blocking, 0.1)
+
+    def test_blocked_consumers_do_not_pile_up_watches(self):
+        queue = ShardedQueue(self.conn, '/queue', 4)
+        producer = ShardedQueue(self.connect(), '/queue', 4)
+        for round in range(5):
+            timer = threading.Timer(0.05, producer.push, (str(round),))
+            timer.start()
+            self.assertEqual(queue.pop_blocking(timeout=2), str(round))
+            timer.join()
+        watches = sum(len(self.fake._child_watches.get(shard.path, ()))
+                      for shard in queue.shards)
+        self.assertTrue(watches <= 4)
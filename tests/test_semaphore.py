@@ -0,0 +1,71 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.semaphore import Semaphore
+
+
+class SemaphoreTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/semaphore')
+
+    def semaphores(self, count, permits = 2):
+        return [Semaphore(self.connect(), '/semaphore', permits) for _ in range(count)]
+
+    def test_permits(self):
+        first, second, third = self.semaphores(3)
+        self.assertTrue(first.acquire())
+        self.assertTrue(second.acquire())
+        self.assertFalse(third.acquire())
+        self.assertFalse(third.is_owner())
+
+    def test_release_frees_permit(self):
+        semaphores = self.semaphores(5)
+        for semaphore in semaphores:
+            semaphore.acquire()
+        for index in range(3):
+            semaphores[index].release()
+            self.assertTrue(self.wait_until(semaphores[index + 2].is_owner))
+            self.assertFalse(semaphores[index + 3:] and semaphores[index + 3].is_owner())
+
+    def test_timeout(self):
+        first, second, third = self.semaphores(3)
+        first.acquire()
+        second.acquire()
+        self.assertFalse(third.acquire(True, 0.1))
+        self.assertEqual(len(self.conn.get_children('/semaphore')), 2)
+
+    def test_predecessor_took_permit_before_watch(self):
+        first, second, third, fourth = self.semaphores(4)
+        first.acquire()
+        second.acquire()
+        third.acquire()
+        # first releases and third takes its permit between the listing of
+        # fourth and its watch on third
+        listing = fourth._connection.get_children
+        def get_children(*args):
+            children = listing(*args)
+            if first.id:
+                first.release()
+                third.acquire(True, 1)
+            return children
+        fourth._connection.get_children = get_children
+        self.assertFalse(fourth.acquire())
+        self.assertTrue(third.is_owner())
+        second.release()
+        self.assertTrue(fourth.acquire(True, 2))
+
+    def test_arrivals_do_not_relist(self):
+        semaphores = self.semaphores(20)
+        for semaphore in semaphores[:3]:
+            semaphore.acquire()
+        self.fake.counters.clear()
+        for semaphore in semaphores[3:]:
+            semaphore.acquire()
+        # a single listing per arrival, by the arriving waiter
+        self.assertEqual(self.fake.counters['get_children'], 17)
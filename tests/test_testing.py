@@ -0,0 +1,54 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.acl import Acls
+import zookeeper
+
+
+class FakeZookeeperTest(FakeTestCase):
+
+    def test_tree(self):
+        self.create('/a/b')
+        self.assertEqual(self.conn.get_children('/a'), ['b'])
+        self.conn.set('/a/b', 'data')
+        self.assertEqual(self.conn.get('/a/b')[0], 'data')
+        self.assertRaises(zookeeper.NoNodeException, self.conn.get, '/missing')
+        self.assertRaises(zookeeper.NotEmptyException, self.conn.delete, '/a')
+
+    def test_sequence(self):
+        self.create('/seq')
+        first = self.conn.create('/seq/item-', '', [Acls.Unsafe], zookeeper.SEQUENCE)
+        second = self.conn.create('/seq/item-', '', [Acls.Unsafe], zookeeper.SEQUENCE)
+        self.assertEqual(first, '/seq/item-0000000000')
+        self.assertEqual(second, '/seq/item-0000000001')
+
+    def test_ephemerals_expire(self):
+        other = self.connect()
+        other.create('/node', '', [Acls.Unsafe], zookeeper.EPHEMERAL)
+        self.fake.expire_session(other.handle)
+        self.assertEqual(self.conn.exists('/node'), None)
+
+    def test_watch_fires_once(self):
+        events = []
+        self.create('/node')
+        self.conn.exists('/node', lambda handle, type, state, path: events.append(type))
+        self.conn.set('/node', '1')
+        self.conn.set('/node', '2')
+        self.assertTrue(self.wait_until(lambda: events))
+        self.assertEqual(events, [zookeeper.CHANGED_EVENT])
+
+    def test_reconnect_delivers_missed_events(self):
+        events = []
+        other = self.connect()
+        self.create('/node')
+        self.conn.exists('/node', lambda handle, type, state, path: events.append((type, path)))
+        self.fake.disconnect(self.conn.handle)
+        other.set('/node', 'changed')
+        changed = lambda: (zookeeper.CHANGED_EVENT, '/node') in events
+        self.assertFalse(self.wait_until(changed, 0.05))
+        self.fake.reconnect(self.conn.handle)
+        self.assertTrue(self.wait_until(changed))
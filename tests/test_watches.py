@@ -0,0 +1,81 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from tests import FakeTestCase
+from zkpy.connection import EventType, KeeperState
+import time
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, type, state, path):
+        self.events.append((type, path))
+
+
+class SubscribeTest(FakeTestCase):
+
+    def setUp(self):
+        FakeTestCase.setUp(self)
+        self.create('/node')
+        self.other = self.connect()
+
+    def test_subscribers_share_a_watch(self):
+        first, second = Recorder(), Recorder()
+        self.conn.subscribe('/node', first, [EventType.NodeDataChanged])
+        self.conn.subscribe('/node', second)
+        self.assertTrue(self.wait_until(lambda: '/node' in self.fake._data_watches))
+        self.other.set('/node', '1')
+        self.assertTrue(self.wait_until(lambda: len(second.events) == 1))
+        self.other.set('/node', '2')
+        self.assertTrue(self.wait_until(lambda: len(second.events) == 2))
+        self.assertEqual(first.events, [(EventType.NodeDataChanged, '/node')] * 2)
+        self.assertEqual(len(self.fake._data_watches['/node']), 1)
+
+    def test_cancel(self):
+        recorder = Recorder()
+        subscription = self.conn.subscribe('/node', recorder)
+        self.assertTrue(self.wait_until(lambda: '/node' in self.fake._data_watches))
+        subscription.cancel()
+        self.other.set('/node', '1')
+        time.sleep(0.1)
+        self.assertEqual(recorder.events, [])
+
+    def test_prefix(self):
+        self.create('/node/child')
+        recorder = Recorder()
+        self.conn.subscribe('/node', recorder, prefix=True)
+        self.conn.subscribe('/node/child', Recorder(), [EventType.NodeDataChanged])
+        self.assertTrue(self.wait_until(lambda: '/node/child' in self.fake._data_watches))
+        self.other.set('/node/child', '1')
+        self.assertTrue(self.wait_until(
+                lambda: (EventType.NodeDataChanged, '/node/child') in recorder.events))
+
+    def test_session_events(self):
+        recorder = Recorder()
+        self.conn.subscribe('/node', recorder, prefix=True)
+        session = Recorder()
+        self.conn.subscribe('', session, [EventType.NoneType])
+        self.fake.disconnect(self.conn.handle)
+        self.fake.reconnect(self.conn.handle)
+        self.assertTrue(self.wait_until(lambda: len(session.events) == 2))
+        self.assertTrue(self.wait_until(lambda: len(recorder.events) == 2))
+        self.assertEqual(recorder.events, session.events)
+
+    def test_coalesce(self):
+        recorder = Recorder()
+        self.conn.subscribe('/node', recorder, [EventType.NodeDataChanged],
+                            coalesce=0.2)
+        self.assertTrue(self.wait_until(lambda: '/node' in self.fake._data_watches))
+        self.other.set('/node', '1')
+        time.sleep(0.05)
+        self.other.set('/node', '2')
+        time.sleep(0.05)
+        self.other.set('/node', '3')
+        time.sleep(0.4)
+        self.assertEqual(recorder.events, [(EventType.NodeDataChanged, '/node')])
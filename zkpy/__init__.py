@@ -1,7 +1,12 @@
 from functools import wraps
 import logging
 import time
-import zookeeper
+
+try:
+    import zookeeper
+except ImportError:
+    # without the C binding, zkpy.testing.install() provides the module
+    zookeeper = None
 
 
 logger = logging.getLogger(__name__)
@@ -0,0 +1,81 @@
+'''
+Created on 16.10.2010
+
+@author: luk
+'''
+
+from zkpy import zk_retry_operation
+from zkpy.exceptions import NoNodeException
+import logging
+import threading
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+class IdAllocator(object):
+    '''Distributed id allocator.
+    The allocator node stores the next free id. Clients reserve a block of
+    block_size ids at once, by setting the node to the end of the block with
+    the version they read (compare and swap), and hand out the ids of the
+    block locally. Unused ids of a block are lost, when the client goes away.
+    '''
+
+    def __init__(self, connection, path, block_size = 1000, max_retry_count = 100):
+        '''Allocator construction.
+        :param connection: The zkpy connection
+        :param path: Allocator node. Needs to exist, empty data counts as 0.
+        :param block_size: Number of ids reserved at once
+        :param max_retry_count: Number of attempts to reserve a block, when
+                                other clients reserve at the same time
+        '''
+        self._connection = connection
+        self._path = path
+        self.block_size = block_size
+        self.max_retry_count = max_retry_count
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+        self.reservations = 0
+
+    @property
+    def path(self):
+        return self._path
+
+    def next_id(self):
+        '''Returns an unique id'''
+        self._lock.acquire()
+        try:
+            if self._next >= self._end:
+                self._next, self._end = self._reserve(self.block_size)
+            id = self._next
+            self._next += 1
+            return id
+        finally:
+            self._lock.release()
+
+    def _reserve(self, count):
+        '''Reserves count ids. Returns the first and the end of the block.'''
+        for _retry_count in range(self.max_retry_count):
+            try:
+                data, stat = zk_retry_operation(self._connection.get)(self._path)
+            except zookeeper.NoNodeException:
+                raise NoNodeException('Node %s needs to exist.' % self._path)
+            start = int(data or 0)
+            try:
+                zk_retry_operation(self._connection.set)(self._path,
+                                                         str(start + count),
+                                                         stat['version'])
+            except zookeeper.BadVersionException:
+                logger.debug('Concurrent reservation on %s. Retrying...' % self._path)
+                continue
+            self.reservations += 1
+            return start, start + count
+        raise RuntimeError('Could not reserve ids on %s' % self._path)
+
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+'''
+Created on 16.10.2010
+
+@author: luk
+'''
+
+from zkpy import zk_retry_operation
+from zkpy.connection import EventType, KeeperState, NodeCreationMode
+from zkpy.exceptions import NoNodeException
+from zkpy.utils import join_path
+import logging
+import threading
+import time
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+def _wait_for_node(connection, path, present, timeout):
+    '''Waits until the node at path exists (or not, if present is False).
+    Every call sets a single exists watch, the node is checked again only if
+    it fires. Returns False, if the timeout passed. Raises a
+    SessionExpiredException, if the session expires meanwhile.
+    '''
+    until = timeout is not None and time.time() + timeout
+    while True:
+        changed = threading.Event()
+        expired = []
+        def watcher(handle, type, state, path):
+            if type != EventType.NoneType:
+                changed.set()
+            elif state == KeeperState.Expired:
+                # the watch is gone with the session
+                expired.append(state)
+                changed.set()
+        stat = zk_retry_operation(connection.exists)(path, watcher)
+        if bool(stat) == present:
+            return True
+        remaining = None
+        if timeout is not None:
+            remaining = until - time.time()
+            if remaining <= 0:
+                return False
+        changed.wait(remaining)
+        if expired:
+            raise zookeeper.SessionExpiredException('Session expired while waiting for %s' % path)
+
+
+class Barrier(object):
+    '''Distributed barrier.
+    The barrier is up as long as its node exists. Waiting clients hold one
+    exists watch each, which fires once the barrier is removed.
+    '''
+
+    def __init__(self, connection, path):
+        '''Barrier construction.
+        :param connection: The zkpy connection
+        :param path: Barrier node. Its parent needs to exist, the barrier
+                     node gets the same ACL as its parent.
+        '''
+        self._connection = connection
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def set_barrier(self):
+        '''Raises the barrier. Does nothing, if it is up already.'''
+        parent = self._path[:self._path.rfind('/')] or '/'
+        try:
+            _stat, acls = self._connection.get_acl(parent)
+            zk_retry_operation(self._connection.create)(self._path, '', acls,
+                                                        NodeCreationMode.Persistent)
+        except zookeeper.NodeExistsException:
+            pass
+        except zookeeper.NoNodeException:
+            raise NoNodeException('Node %s needs to exist.' % parent)
+
+    def remove_barrier(self):
+        '''Removes the barrier and lets the waiting clients pass'''
+        try:
+            zk_retry_operation(self._connection.delete)(self._path)
+        except zookeeper.NoNodeException:
+            logger.warn('Barrier %s is not set' % self._path)
+
+    def wait(self, timeout = None):
+        '''Waits until the barrier is removed.
+        Returns False, if the timeout passed before.
+        :param timeout: Maximal time to wait in seconds, None waits forever
+        '''
+        return _wait_for_node(self._connection, self._path, False, timeout)
+
+
+class DoubleBarrier(object):
+    '''Distributed double barrier.
+    Participants enter the barrier and proceed together, once count of them
+    have entered. Later on, they leave it and proceed, once all of them have
+    left. Instead of listing the participants on every arrival, the number
+    of participant nodes is taken from the stat of the barrier node (less the
+    ready node) and all participants wait on the single ready node: the last
+    one to enter creates it, the last one to leave deletes it.
+    '''
+
+    def __init__(self, connection, path, count):
+        '''Double barrier construction.
+        :param connection: The zkpy connection
+        :param path: Parent node of the participant nodes. Needs to exist.
+                     Note: children will have the same ACL as this node
+        :param count: Number of participants to wait for
+        '''
+        self._connection = connection
+        self._path = path
+        self._ready_path = join_path(path, 'ready')
+        self.count = count
+        self._node = None
+
+        try:
+            _stat, self._acls = self._connection.get_acl(path)
+        except zookeeper.NoNodeException:
+            raise NoNodeException('Node %s needs to exist.' % self._path)
+
+    @property
+    def path(self):
+        return self._path
+
+    @zk_retry_operation
+    def _participants(self):
+        '''Returns the number of participant nodes and whether the ready node
+        exists. Both are read from stats in a single round trip.
+        '''
+        ready = self._connection.exists_async(self._ready_path)
+        barrier = self._connection.exists_async(self._path)
+        ready, stat = ready.result(), barrier.result()
+        if not stat:
+            raise NoNodeException('Node %s needs to exist.' % self._path)
+        if ready:
+            return stat['numChildren'] - 1, True
+        return stat['numChildren'], False
+
+    def enter(self, timeout = None):
+        '''Enters the barrier and waits for the other participants.
+        Returns False, if the timeout passed before. The participant node is
+        removed then.
+        :param timeout: Maximal time to wait in seconds, None waits forever
+        '''
+        self._node = zk_retry_operation(self._connection.create)(
+                                        join_path(self._path, 'member-'), '',
+                                        self._acls,
+                                        NodeCreationMode.EphemeralSequential)
+        participants, _ready = self._participants()
+        if participants >= self.count:
+            # a ready node created after it was read is counted as well, but
+            # then we can go anyway
+            try:
+                zk_retry_operation(self._connection.create)(self._ready_path,
+                                        '', self._acls, NodeCreationMode.Persistent)
+            except zookeeper.NodeExistsException:
+                pass
+            return True
+
+        if _wait_for_node(self._connection, self._ready_path, True, timeout):
+            return True
+        self._remove_node()
+        return False
+
+    def leave(self, timeout = None):
+        '''Leaves the barrier and waits for the other participants to leave.
+        Returns False, if the timeout passed before.
+        :param timeout: Maximal time to wait in seconds, None waits forever
+        '''
+        self._remove_node()
+        participants, _ready = self._participants()
+        if participants <= 0:
+            # we are the last one
+            try:
+                zk_retry_operation(self._connection.delete)(self._ready_path)
+            except zookeeper.NoNodeException:
+                pass
+            return True
+        return _wait_for_node(self._connection, self._ready_path, False, timeout)
+
+    def _remove_node(self):
+        if not self._node:
+            return
+        node, self._node = self._node, None
+        try:
+            zk_retry_operation(self._connection.delete)(node)
+        except zookeeper.NoNodeException:
+            logger.warn('Participant node %s is already gone' % node)
+
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+Created on 15.10.2010
+
+@author: luk
+
+Benchmarks for zkpy's recipes. Run them with
+
+    python -m zkpy.benchmark --fake --latency 0.001 lock_handoff queue
+
+or against a server with --servers localhost:2181. The results are printed
+as JSON (latencies in milliseconds), which allows to diff runs; pass an
+earlier result with --baseline to print the relative changes.
+'''
+
+import math
+import threading
+import time
+
+
+# name -> scenario function
+SCENARIOS = {}
+
+def scenario(name):
+    '''Registers a benchmark scenario.
+    The scenario is called as function(connect, root, options), where
+    connect() returns a new zkpy connection, root is an existing node for
+    the benchmark's nodes and options are the parsed command line options.
+    It returns a dict with the results.
+    '''
+    def register(function):
+        SCENARIOS[name] = function
+        return function
+    return register
+
+
+def percentiles(samples, points = (50, 90, 99)):
+    '''Summarizes the samples (seconds) in milliseconds.
+
+        >>> percentiles([0.001, 0.002, 0.003, 0.004])['p50']
+        2.0
+    '''
+    if not samples:
+        return {'count' : 0}
+    samples = sorted(samples)
+    count = len(samples)
+    summary = {'count' : count,
+               'mean'  : 1000. * sum(samples) / count,
+               'min'   : 1000. * samples[0],
+               'max'   : 1000. * samples[-1]}
+    for point in points:
+        # nearest rank
+        rank = max(1, int(math.ceil(point / 100. * count)))
+        summary['p%d' % point] = 1000. * samples[rank - 1]
+    return summary
+
+
+class Stopwatch(object):
+    '''Measures the wall time of a with block'''
+
+    def __init__(self):
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.elapsed = time.time() - self.start
+
+
+def run_threads(target, count):
+    '''Runs target(index) in count threads and waits for them.
+    Reraises the first exception of a thread.
+    '''
+    errors = []
+    def runner(index):
+        try:
+            target(index)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=runner, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def compare(result, baseline):
+    '''Returns the relative changes of result's numbers to the baseline as a
+    dict with the same structure (1.0 means unchanged).
+    '''
+    changes = {}
+    for key, value in result.iteritems():
+        base = baseline.get(key)
+        if isinstance(value, dict) and isinstance(base, dict):
+            changes[key] = compare(value, base)
+        elif (isinstance(value, (int, float)) and isinstance(base, (int, float))
+              and base):
+            changes[key] = float(value) / base
+    return changes
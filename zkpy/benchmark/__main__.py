@@ -0,0 +1,124 @@
+'''
+Created on 15.10.2010
+
+@author: luk
+
+Command line entry point: python -m zkpy.benchmark --help
+'''
+
+from optparse import OptionParser
+import json
+import logging
+import sys
+
+
+def parse_options(argv):
+    parser = OptionParser(usage='%prog [options] [scenario ...]')
+    parser.add_option('--servers', default='localhost:2181',
+                      help='zookeeper servers (default: %default)')
+    parser.add_option('--fake', action='store_true', default=False,
+                      help='use the in-memory zkpy.testing backend')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='request latency of the fake backend (seconds)')
+    parser.add_option('--jitter', type='float', default=0.0,
+                      help='maximal jitter of the fake backend (seconds)')
+    parser.add_option('--root', default='/zkpy-benchmark',
+                      help='parent node of the benchmark nodes (default: %default)')
+    parser.add_option('--timeout', type='float', default=10.0,
+                      help='connection and notification timeout (seconds)')
+    parser.add_option('--contenders', type='int', default=5)
+    parser.add_option('--waiters', default='10,100,1000',
+                      help='waiter counts of the lock_contention scenario (default: %default)')
+    parser.add_option('--rounds', type='int', default=200)
+    parser.add_option('--producers', type='int', default=2)
+    parser.add_option('--consumers', type='int', default=2)
+    parser.add_option('--items', type='int', default=500,
+                      help='items per producer')
+    parser.add_option('--shards', type='int', default=1,
+                      help='shards of the queue scenario (default: %default)')
+    parser.add_option('--prefetch', type='int', default=100,
+                      help='items removed per round trip by Queue.consume')
+    parser.add_option('--events', type='int', default=500)
+    parser.add_option('--window', type='float', default=0.05,
+                      help='coalescing window of the churn scenario (seconds)')
+    parser.add_option('--fanout', type='int', default=10)
+    parser.add_option('--depth', type='int', default=3)
+    parser.add_option('--dispatch-threads', type='int', default=0,
+                      help='run the watchers on a dispatch executor with this '
+                           'many threads (default: on the client thread)')
+    parser.add_option('--output', help='write the results to this file')
+    parser.add_option('--baseline',
+                      help='earlier result file to compare the results to')
+    return parser.parse_args(argv)
+
+
+def main(argv = None):
+    options, names = parse_options(argv)
+    logging.basicConfig(level=logging.WARN)
+
+    # set up the backend before zkpy.connection is imported
+    backend = None
+    if options.fake:
+        import zkpy
+        from zkpy.testing import FakeZookeeper, install
+        backend = FakeZookeeper(latency=options.latency, jitter=options.jitter)
+        if zkpy.zookeeper is None:
+            install(backend)
+
+    from zkpy.acl import Acls
+    from zkpy.benchmark import SCENARIOS, compare
+    # registers the scenarios in SCENARIOS
+    import zkpy.benchmark.scenarios
+    from zkpy.connection import Connection
+    from zkpy.dispatch import DispatchExecutor
+
+    executor = None
+    if options.dispatch_threads:
+        executor = DispatchExecutor(options.dispatch_threads)
+
+    def connect():
+        return Connection(options.servers, options.timeout, backend=backend,
+                          executor=executor)
+
+    names = names or sorted(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            sys.stderr.write('Unknown scenario %s. Choose from %s\n' % (name, ', '.join(sorted(SCENARIOS))))
+            return 2
+
+    conn = connect()
+    conn.ensure_path_exists(options.root, '', [Acls.Unsafe], True)
+    results = {}
+    try:
+        for name in names:
+            results[name] = SCENARIOS[name](connect, options.root, options)
+    finally:
+        conn.delete_recursive(options.root)
+        conn.close()
+        if executor is not None:
+            executor.shutdown()
+
+    report = {'backend' : options.fake and 'fake' or options.servers,
+              'results' : results}
+    if options.fake:
+        report['latency'] = options.latency
+        report['jitter'] = options.jitter
+    if executor is not None:
+        report['dispatch_threads'] = options.dispatch_threads
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+        report['changes'] = compare(results, baseline.get('results', {}))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        out = open(options.output, 'w')
+        try:
+            out.write(output + '\n')
+        finally:
+            out.close()
+    sys.stdout.write(output + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
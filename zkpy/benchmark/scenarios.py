@@ -0,0 +1,427 @@
+'''
+Created on 15.10.2010
+
+@author: luk
+'''
+
+from collections import deque
+from zkpy.acl import Acls
+from zkpy.benchmark import scenario, percentiles, run_threads, Stopwatch
+from zkpy.connection import EventType
+from zkpy.election import LeaderElection
+from zkpy.exceptions import TimeoutException
+from zkpy.lock import Lock
+from zkpy.queue import Queue, ShardedQueue
+from zkpy.utils import join_path
+import threading
+import time
+
+
+class _Mailbox(object):
+    '''Hands over values from watcher threads to the benchmark thread'''
+
+    def __init__(self):
+        self._items = deque()
+        self._condition = threading.Condition()
+
+    def put(self, item):
+        self._condition.acquire()
+        try:
+            self._items.append(item)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def get(self, timeout):
+        until = time.time() + timeout
+        self._condition.acquire()
+        try:
+            while not self._items:
+                remaining = until - time.time()
+                if remaining <= 0:
+                    raise TimeoutException('No item within %.2f seconds' % timeout)
+                self._condition.wait(remaining)
+            return self._items.popleft()
+        finally:
+            self._condition.release()
+
+
+class _LockObserver(object):
+    '''Reports lock acquisitions to a mailbox'''
+
+    def __init__(self, index, mailbox):
+        self.index = index
+        self.mailbox = mailbox
+
+    def lock_acquired(self):
+        self.mailbox.put((self.index, time.time()))
+
+    def lock_released(self):
+        pass
+
+
+@scenario('lock_handoff')
+def lock_handoff(connect, root, options):
+    '''Time between the release of a lock and the notification of the next
+    owner, with options.contenders contending connections.
+    '''
+    path = join_path(root, 'lock')
+    connections = [connect() for _ in range(options.contenders)]
+    connections[0].ensure_path_exists(path, '', [Acls.Unsafe])
+    acquired = _Mailbox()
+    locks = [Lock(conn, path, _LockObserver(index, acquired))
+             for index, conn in enumerate(connections)]
+    try:
+        for lock in locks:
+            lock.acquire()
+        holder, _at = acquired.get(options.timeout)
+
+        samples = []
+        with Stopwatch() as total:
+            for _ in range(options.rounds):
+                released = time.time()
+                locks[holder].release()
+                # queue up again
+                locks[holder].acquire()
+                holder, at = acquired.get(options.timeout)
+                samples.append(at - released)
+    finally:
+        for lock in locks:
+            if lock.id:
+                lock.release()
+        for conn in connections:
+            conn.close()
+
+    return {'contenders'  : options.contenders,
+            'handoff'     : percentiles(samples),
+            'handoffs_per_second' : len(samples) / total.elapsed}
+
+
+@scenario('lock_contention')
+def lock_contention(connect, root, options):
+    '''Handoff latency and requests per handoff of a lock with an increasing
+    number of waiting connections (options.waiters, comma separated). The
+    request counts and listing sizes are only reported with the fake backend.
+    '''
+    result = {}
+    for waiters in [int(count) for count in options.waiters.split(',')]:
+        path = join_path(root, 'contention-%d' % waiters)
+        result[str(waiters)] = _contend(connect, path, waiters, options)
+    return result
+
+def _contend(connect, path, waiters, options):
+    connections = [connect() for _ in range(waiters + 1)]
+    connections[0].ensure_path_exists(path, '', [Acls.Unsafe])
+    counters = connections[0].request_counters()
+    acquired = _Mailbox()
+    locks = [Lock(conn, path, _LockObserver(index, acquired))
+             for index, conn in enumerate(connections)]
+    try:
+        for lock in locks:
+            lock.acquire()
+        holder, _at = acquired.get(options.timeout)
+
+        # the released holders do not queue up again
+        samples = []
+        before = connections[0].request_counters()
+        for _ in range(min(options.rounds, waiters)):
+            released = time.time()
+            locks[holder].release()
+            holder, at = acquired.get(options.timeout)
+            samples.append(at - released)
+        after = connections[0].request_counters()
+    finally:
+        for lock in locks:
+            if lock.id:
+                lock.release()
+        connections[0].delete(path)
+        for conn in connections:
+            conn.close()
+
+    result = {'handoff' : percentiles(samples)}
+    if counters is not None:
+        def per_handoff(name):
+            return float(after.get(name, 0) - before.get(name, 0)) / len(samples)
+        # the delete of the releasing holder is not part of the handoff
+        requests = sum([per_handoff(name) for name in after
+                        if name != 'listed_children']) - 1
+        result['requests_per_handoff'] = requests
+        result['listings_per_handoff'] = per_handoff('get_children')
+        result['listed_children_per_handoff'] = per_handoff('listed_children')
+    return result
+
+
+class _ElectionObserver(object):
+    '''Reports published leaders to a mailbox'''
+
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+
+    def elected(self):
+        pass
+
+    def deposed(self):
+        pass
+
+    def leader_changed(self, data):
+        if data is not None:
+            self.mailbox.put((data, time.time()))
+
+
+@scenario('failover')
+def failover(connect, root, options):
+    '''Time between the resignation of a leader and a follower learning about
+    the new one, with options.contenders candidates. The resigned leader
+    joins again, options.rounds times.
+    '''
+    path = join_path(root, 'election')
+    follower = connect()
+    follower.ensure_path_exists(path, '', [Acls.Unsafe])
+    connections = [connect() for _ in range(options.contenders)]
+    published = _Mailbox()
+    observed = LeaderElection(follower, path, observer=_ElectionObserver(published),
+                              follow=True)
+    elections = [LeaderElection(conn, path, str(index))
+                 for index, conn in enumerate(connections)]
+    try:
+        for election in elections:
+            election.join()
+        leader, _at = published.get(options.timeout)
+
+        samples = []
+        handovers = []
+        for _ in range(options.rounds):
+            resigned = time.time()
+            elections[int(leader)].resign()
+            elections[int(leader)].join()
+            leader, at = published.get(options.timeout)
+            samples.append(at - resigned)
+            handovers.append(observed.handover_time)
+    finally:
+        for election in elections:
+            election.resign()
+            election.close()
+        observed.close()
+        for conn in connections:
+            conn.close()
+        follower.delete_recursive(path)
+        follower.close()
+
+    return {'candidates' : options.contenders,
+            'failover'   : percentiles(samples),
+            'handover'   : percentiles(handovers)}
+
+
+@scenario('queue')
+def queue_throughput(connect, root, options):
+    '''Push and pop latencies and throughput of options.producers producers
+    pushing options.items items each and options.consumers consumers. With
+    options.shards > 1, a ShardedQueue is used.
+    '''
+    path = join_path(root, 'queue')
+    total_items = options.producers * options.items
+    setup = connect()
+    setup.ensure_path_exists(path, '', [Acls.Unsafe])
+
+    def open_queue(conn, index):
+        if options.shards > 1:
+            return ShardedQueue(conn, path, options.shards, home=index)
+        return Queue(conn, path)
+
+    push_samples = []
+    pop_samples = []
+    consumed = [0]
+    lock = threading.Lock()
+
+    def produce(index):
+        conn = connect()
+        try:
+            queue = open_queue(conn, index)
+            for item in range(options.items):
+                with Stopwatch() as push:
+                    queue.push('%d-%d' % (index, item))
+                push_samples.append(push.elapsed)
+        finally:
+            conn.close()
+
+    def consume(index):
+        conn = connect()
+        try:
+            queue = open_queue(conn, index)
+            while True:
+                with lock:
+                    if consumed[0] >= total_items:
+                        return
+                try:
+                    with Stopwatch() as pop:
+                        queue.pop()
+                except IndexError:
+                    time.sleep(0.001)
+                    continue
+                pop_samples.append(pop.elapsed)
+                with lock:
+                    consumed[0] += 1
+        finally:
+            conn.close()
+
+    def run(index):
+        if index < options.producers:
+            produce(index)
+        else:
+            consume(index - options.producers)
+
+    try:
+        with Stopwatch() as total:
+            run_threads(run, options.producers + options.consumers)
+    finally:
+        setup.delete_recursive(path)
+        setup.close()
+
+    return {'producers'   : options.producers,
+            'consumers'   : options.consumers,
+            'shards'      : options.shards,
+            'push'        : percentiles(push_samples),
+            'pop'         : percentiles(pop_samples),
+            'items_per_second' : total_items / total.elapsed}
+
+
+@scenario('watch')
+def watch_dispatch(connect, root, options):
+    '''Time between a data change and the notification of a data watch,
+    measured options.events times.
+    '''
+    path = join_path(root, 'watched')
+    writer = connect()
+    reader = connect()
+    writer.ensure_path_exists(path, '', [Acls.Unsafe])
+    fired = _Mailbox()
+    def watcher(handle, type, state, path):
+        fired.put(time.time())
+
+    samples = []
+    try:
+        with Stopwatch() as total:
+            for event in range(options.events):
+                reader.exists(path, watcher)
+                changed = time.time()
+                writer.set(path, str(event))
+                samples.append(fired.get(options.timeout) - changed)
+    finally:
+        writer.delete(path)
+        writer.close()
+        reader.close()
+
+    return {'notification' : percentiles(samples),
+            'events_per_second' : len(samples) / total.elapsed}
+
+
+@scenario('churn')
+def churn(connect, root, options):
+    '''A subscriber reading a node on its events, while the node is set
+    options.events times in a row. Compares a plain subscription to one
+    coalescing the events of options.window seconds.
+    '''
+    path = join_path(root, 'churn')
+    writer = connect()
+    reader = connect()
+    writer.ensure_path_exists(path, '', [Acls.Unsafe])
+    last = str(options.events - 1)
+    result = {'events' : options.events, 'window' : options.window}
+    try:
+        for name, window in (('plain', None), ('coalesced', options.window)):
+            reads = [0]
+            settled = _Mailbox()
+            def callback(type, state, path):
+                reads[0] += 1
+                data, _stat = reader.get(path)
+                if data == last:
+                    settled.put(time.time())
+            writer.set(path, '')
+            subscription = reader.subscribe(path, callback,
+                                            [EventType.NodeDataChanged],
+                                            coalesce=window)
+            # the watch is set once the reader's requests are answered
+            reader.exists(path)
+            for event in range(options.events):
+                writer.set(path, str(event))
+            written = time.time()
+            settle = settled.get(options.timeout) - written
+            subscription.cancel()
+            time.sleep(options.window)
+            result[name] = {'reads' : reads[0],
+                            'reads_per_change' : reads[0] / float(options.events),
+                            'settle_seconds' : settle}
+    finally:
+        writer.delete(path)
+        writer.close()
+        reader.close()
+    return result
+
+
+@scenario('tree')
+def tree_operations(connect, root, options):
+    '''Creates, reads and deletes a tree with options.fanout children per
+    node and options.depth levels.
+    '''
+    path = join_path(root, 'tree')
+    leaves = [path]
+    for _ in range(options.depth):
+        leaves = [join_path(parent, 'node-%d' % child)
+                  for parent in leaves for child in range(options.fanout)]
+
+    conn = connect()
+    try:
+        with Stopwatch() as create:
+            created = conn.ensure_tree(leaves, '', [Acls.Unsafe])
+        with Stopwatch() as walk:
+            read = len(list(conn.walk(path)))
+        with Stopwatch() as delete:
+            deleted = conn.delete_recursive(path)
+    finally:
+        conn.close()
+
+    return {'nodes'       : created,
+            'create_seconds' : create.elapsed,
+            'walk_seconds'   : walk.elapsed,
+            'delete_seconds' : delete.elapsed,
+            'read'        : read,
+            'deleted'     : deleted}
+
+
+@scenario('queue_drain')
+def queue_drain(connect, root, options):
+    '''Fills a queue with options.items items using push() and push_many()
+    and drains it with pop() and consume(prefetch=options.prefetch).
+    '''
+    path = join_path(root, 'drain')
+    conn = connect()
+    conn.ensure_path_exists(path, '', [Acls.Unsafe])
+    queue = Queue(conn, path)
+    items = [str(item) for item in range(options.items)]
+    result = {'items' : options.items, 'prefetch' : options.prefetch}
+    try:
+        for fill_name, fill, drain_name, drain in (
+                ('push', lambda: [queue.push(item) for item in items],
+                 'pop', lambda: _pop_all(queue)),
+                ('push_many', lambda: queue.push_many(items),
+                 'consume', lambda: list(queue.consume(options.prefetch)))):
+            with Stopwatch() as total:
+                fill()
+            result[fill_name] = {'seconds' : total.elapsed,
+                                 'items_per_second' : len(items) / total.elapsed}
+            with Stopwatch() as total:
+                drained = len(drain())
+            result[drain_name] = {'seconds' : total.elapsed,
+                                  'items_per_second' : drained / total.elapsed}
+    finally:
+        conn.delete_recursive(path)
+        conn.close()
+    return result
+
+def _pop_all(queue):
+    items = []
+    while True:
+        try:
+            items.append(queue.pop())
+        except IndexError:
+            return items
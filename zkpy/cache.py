@@ -0,0 +1,588 @@
+'''
+Created on 16.10.2010
+
+@author: luk
+'''
+
+from Queue import Queue
+from zkpy import zk_retry_operation, RetryOperationError
+from zkpy.connection import EventType, KeeperState
+from zkpy.future import gather, pipeline
+from zkpy.utils import LRUCache, join_path
+import logging
+import mmap
+import os
+import struct
+import threading
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+# kinds of cached reads
+_DATA, _STAT, _CHILDREN = range(3)
+
+class NodeCache(object):
+    '''Read cache of a connection.
+    get(), exists() and get_children() are served from memory once read.
+    Every read from the server sets a watch, which drops the entry, when the
+    node changes. A path gets one data and one child watch at most: reads of
+    a watched path, e.g. after its entry was evicted, set no further watch.
+    At most max_size entries are kept, the least recently used
+    ones are dropped first. Session events drop all entries, as watch events
+    may have been missed.
+    Note: data watches do not fire on child changes, thus numChildren and
+    cversion of a cached stat may be outdated, unless the children of that
+    node are read through the cache as well.
+    '''
+
+    def __init__(self, connection, max_size = 10000):
+        '''Cache construction.
+        :param connection: The zkpy connection
+        :param max_size: Maximal number of cached reads
+        '''
+        self._connection = connection
+        self._entries = LRUCache(max_size)
+        # (kind, path) -> token of the reads in flight. Invalidations remove
+        # the token, so that the outdated result is not stored.
+        self._fetching = {}
+        # paths with a data/child watch set, which did not fire yet
+        self._data_watched = set()
+        self._child_watched = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._session_subscription = self._connection.subscribe(
+                '', self._session_watcher, [EventType.NoneType])
+
+    def close(self):
+        '''Stops receiving session events and drops all entries'''
+        self._session_subscription.cancel()
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, path):
+        '''Cached Connection.get(). Returns (data, stat).'''
+        return self._read(_DATA, path, self._connection.get)
+
+    def exists(self, path):
+        '''Cached Connection.exists(). Returns the stat or None.'''
+        return self._read(_STAT, path, self._connection.exists)
+
+    def get_children(self, path):
+        '''Cached Connection.get_children()'''
+        return list(self._read(_CHILDREN, path, self._connection.get_children))
+
+    def _read(self, kind, path, call):
+        key = (kind, path)
+        token = object()
+        if kind == _CHILDREN:
+            watched = self._child_watched
+        else:
+            watched = self._data_watched
+        self._lock.acquire()
+        try:
+            # None is a valid result of exists(): look up a wrapping tuple
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            self._fetching[key] = token
+            watch = path not in watched
+            watched.add(path)
+        finally:
+            self._lock.release()
+
+        try:
+            if watch:
+                result = call(path, self._node_watcher)
+            else:
+                # the watch set before drops the result, if the node changed
+                result = call(path)
+        except:
+            self._lock.acquire()
+            try:
+                if self._fetching.get(key) is token:
+                    del self._fetching[key]
+                if watch:
+                    # no watch is set on a missing node
+                    watched.discard(path)
+            finally:
+                self._lock.release()
+            raise
+
+        self._lock.acquire()
+        try:
+            if self._fetching.get(key) is token:
+                del self._fetching[key]
+                self._entries[key] = (result,)
+        finally:
+            self._lock.release()
+        return result
+
+    def invalidate(self, path, kinds = (_DATA, _STAT, _CHILDREN)):
+        '''Drops the cached reads of path'''
+        self._lock.acquire()
+        try:
+            for kind in kinds:
+                key = (kind, path)
+                self._entries.pop(key)
+                self._fetching.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        '''Drops all entries'''
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._fetching.clear()
+        finally:
+            self._lock.release()
+
+    def _node_watcher(self, handle, type, state, path):
+        if type == EventType.NoneType:
+            # handled by the session watcher
+            return
+        self._lock.acquire()
+        try:
+            if type != EventType.NodeChildrenChanged:
+                self._data_watched.discard(path)
+            if type in (EventType.NodeChildrenChanged, EventType.NodeDeleted):
+                self._child_watched.discard(path)
+        finally:
+            self._lock.release()
+        if type == EventType.NodeDataChanged:
+            self.invalidate(path, (_DATA, _STAT))
+        else:
+            # created, deleted or children changed, which changes the stat
+            self.invalidate(path)
+
+    def _session_watcher(self, type, state, path):
+        if state == KeeperState.Expired:
+            # the watches are gone with the session
+            self._lock.acquire()
+            try:
+                self._data_watched.clear()
+                self._child_watched.clear()
+            finally:
+                self._lock.release()
+        if state != KeeperState.Connected:
+            logger.debug('Session event %s. Dropping the cache' % KeeperState[state])
+            self.clear()
+
+
+# snapshot file layout: header and root path, followed by a record per node.
+# A record is the node stat, the path length and the data length (-1 for
+# None) followed by the path and the data.
+_SNAPSHOT_MAGIC = 'ZKPYTREE'
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = struct.Struct('>8sIII')
+_SNAPSHOT_RECORD = struct.Struct('>qqqqiiiqiiqIi')
+_STAT_FIELDS = ('czxid', 'mzxid', 'ctime', 'mtime', 'version', 'cversion',
+                'aversion', 'ephemeralOwner', 'dataLength', 'numChildren',
+                'pzxid')
+
+def _write_snapshot(filename, root, nodes):
+    '''Writes a dictionary of path to (data, stat) of the tree at root to
+    filename. The file is replaced atomically.
+    '''
+    temporary = '%s.%d.tmp' % (filename, os.getpid())
+    out = open(temporary, 'wb')
+    try:
+        out.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION,
+                                        len(root), len(nodes)))
+        out.write(root)
+        for path, (data, stat) in nodes.iteritems():
+            values = [stat[field] for field in _STAT_FIELDS]
+            values.append(len(path))
+            values.append(data is None and -1 or len(data))
+            out.write(_SNAPSHOT_RECORD.pack(*values))
+            out.write(path)
+            if data:
+                out.write(data)
+    finally:
+        out.close()
+    os.rename(temporary, filename)
+
+def _read_snapshot(filename):
+    '''Reads a snapshot file. Returns the root path and a dictionary of path
+    to (data, stat)
+    '''
+    snapshot = open(filename, 'rb')
+    try:
+        size = os.fstat(snapshot.fileno()).st_size
+        if size < _SNAPSHOT_HEADER.size:
+            raise ValueError('%s is no snapshot file' % filename)
+        content = mmap.mmap(snapshot.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        snapshot.close()
+    try:
+        magic, version, root_length, count = _SNAPSHOT_HEADER.unpack_from(content, 0)
+        if magic != _SNAPSHOT_MAGIC or version != _SNAPSHOT_VERSION:
+            raise ValueError('%s is no snapshot file of version %d' % (filename, _SNAPSHOT_VERSION))
+        offset = _SNAPSHOT_HEADER.size
+        root = content[offset:offset + root_length]
+        offset += root_length
+        nodes = {}
+        for _index in xrange(count):
+            values = _SNAPSHOT_RECORD.unpack_from(content, offset)
+            offset += _SNAPSHOT_RECORD.size
+            path_length, data_length = values[-2:]
+            path = content[offset:offset + path_length]
+            offset += path_length
+            data = None
+            if data_length >= 0:
+                data = content[offset:offset + data_length]
+                offset += data_length
+            nodes[path] = (data, dict(zip(_STAT_FIELDS, values)))
+        return root, nodes
+    finally:
+        content.close()
+
+
+class _TreeNode(object):
+    __slots__ = ['data', 'stat', 'children']
+
+    def __init__(self, data, stat, children):
+        self.data = data
+        self.stat = stat
+        self.children = set(children)
+
+
+class TreeCache(object):
+    '''Mirror of a subtree.
+    The data and children of every node in the subtree are read once and
+    watched. On changes, only the affected node is read again: changed child
+    lists are compared with the cached ones, so that only added subtrees are
+    read and removed ones are dropped locally.
+    The mirror may be saved to a snapshot file and used to start the cache:
+    then, the stat of every node is compared with the saved one and only
+    changed data is read.
+    The watch events are processed in order by a worker thread, which is the
+    only one changing the mirror. Observers are called from it as well and
+    need to implement three methods:
+     - node_added(path, data)
+     - node_updated(path, data)
+     - node_removed(path)
+    '''
+
+    def __init__(self, connection, path, observer = None):
+        '''Tree cache construction. Call start() to read the tree.
+        :param connection: The zkpy connection
+        :param path: Root of the mirrored subtree
+        :param observer: Tree observer object
+        '''
+        self._connection = connection
+        self._path = path
+        self.observers = set()
+        if observer:
+            self.register_observer(observer)
+        self._nodes = {}
+        self._lock = threading.RLock()
+        self._events = Queue()
+        self._loaded = threading.Event()
+        self._worker = None
+        self._session_subscription = None
+        self._saved = None
+        # events, which could not be processed. They are processed again,
+        # once the connection is back.
+        self._failed = []
+
+    @property
+    def path(self):
+        return self._path
+
+    def register_observer(self, observer):
+        '''Registers a tree observer'''
+        self.observers.add(observer)
+
+    def start(self, timeout = None, snapshot = None):
+        '''Reads the tree and starts following its changes.
+        Returns False, if the tree was not read within the timeout.
+        :param snapshot: Snapshot file written by save(). If it can be read,
+                         only the nodes changed since are read.
+        '''
+        if snapshot and os.path.exists(snapshot):
+            try:
+                root, saved = _read_snapshot(snapshot)
+            except (ValueError, struct.error, EnvironmentError) as e:
+                logger.warning('Ignoring snapshot %s: %s' % (snapshot, e))
+            else:
+                if root == self._path:
+                    self._saved = saved
+                else:
+                    logger.warning('Ignoring snapshot %s: it is of %s, not of %s'
+                                   % (snapshot, root, self._path))
+        self._session_subscription = self._connection.subscribe(
+                '', self._session_watcher, [EventType.NoneType])
+        self._worker = threading.Thread(target=self._process_events,
+                                        name='zkpy-tree-cache %s' % self._path)
+        self._worker.setDaemon(True)
+        self._worker.start()
+        self._events.put((EventType.NodeCreated, self._path))
+        self._loaded.wait(timeout)
+        return self._loaded.isSet()
+
+    def close(self):
+        '''Stops following the tree'''
+        if self._session_subscription is not None:
+            self._session_subscription.cancel()
+            self._session_subscription = None
+        if self._worker:
+            self._events.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def get(self, path):
+        '''Returns the cached (data, stat) of path or None'''
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(path)
+            if node is None:
+                return None
+            return node.data, node.stat
+        finally:
+            self._lock.release()
+
+    def get_children(self, path):
+        '''Returns the cached children of path or None'''
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(path)
+            if node is None:
+                return None
+            return sorted(node.children)
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        '''Returns a consistent copy of the tree as dictionary of path to
+        (data, stat)
+        '''
+        self._lock.acquire()
+        try:
+            snapshot = {}
+            for path, node in self._nodes.iteritems():
+                snapshot[path] = (node.data, node.stat)
+            return snapshot
+        finally:
+            self._lock.release()
+
+    def save(self, filename):
+        '''Writes the mirror to a snapshot file, see start()'''
+        _write_snapshot(filename, self._path, self.snapshot())
+
+    def _watcher(self, handle, type, state, path):
+        if type == EventType.NoneType:
+            # handled by the session watcher
+            return
+        self._events.put((type, path))
+
+    def _session_watcher(self, type, state, path):
+        if state == KeeperState.Expired:
+            logger.warning('Session expired. Dropping the tree cache of %s' % self._path)
+            self._events.put((EventType.NodeDeleted, self._path))
+        elif state == KeeperState.Connected:
+            # the worker processes the failed events again
+            self._events.put((EventType.NoneType, self._path))
+
+    def _process_events(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            type, path = event
+            if type == EventType.NoneType:
+                failed, self._failed = self._failed, []
+                if failed:
+                    logger.info('Resyncing %d nodes of %s' % (len(failed), self._path))
+                for failed_event in failed:
+                    self._events.put(failed_event)
+                continue
+            try:
+                zk_retry_operation(self._process_event)(type, path)
+            except (zookeeper.ZooKeeperException, RetryOperationError) as e:
+                # the failed read set no watch: without another try, the
+                # node would stay outdated
+                logger.error('Could not process %s of %s: %s. Retrying on reconnect' % (EventType[type], path, e))
+                self._failed.append(event)
+            if path == self._path:
+                self._loaded.set()
+
+    def _process_event(self, type, path):
+        if type == EventType.NodeCreated:
+            self._load(path)
+        elif type == EventType.NodeDeleted:
+            self._remove(path)
+        elif type == EventType.NodeDataChanged:
+            self._update(path)
+        elif type == EventType.NodeChildrenChanged:
+            self._update_children(path)
+
+    def _load(self, path):
+        '''Reads and watches the subtree of path'''
+        if path == self._path and path not in self._nodes:
+            # watch for the creation of the root, if it is missing
+            if not self._connection.exists(path, self._watcher):
+                return
+            if self._saved is not None:
+                saved, self._saved = self._saved, None
+                # without the root, nothing of the saved tree is watched
+                if path in saved:
+                    return self._reconcile(saved)
+        for node_path, data, stat, children in self._connection.walk(path, self._watcher):
+            self._lock.acquire()
+            try:
+                if node_path in self._nodes:
+                    continue
+                self._nodes[node_path] = _TreeNode(data, stat, children)
+            finally:
+                self._lock.release()
+            for observer in list(self.observers):
+                observer.node_added(node_path, data)
+
+    def _reconcile(self, saved, window = 1000):
+        '''Reads the stats and children of the saved nodes and watches them.
+        The data of a node is read again only if it changed meanwhile, added
+        subtrees are read completely.
+        '''
+        saved_children = {}
+        for path in saved:
+            if path != self._path:
+                parent = path[:path.rfind('/')] or '/'
+                saved_children.setdefault(parent, set()).add(path[path.rfind('/') + 1:])
+
+        def check(path):
+            return gather([self._connection.exists_async(path, self._watcher),
+                           self._connection.get_children_async(path, self._watcher)])
+
+        changed = []
+        added = []
+        for path, future in pipeline(check, sorted(saved), window):
+            try:
+                stat, children = future.result()
+            except zookeeper.NoNodeException:
+                continue
+            if stat is None:
+                continue
+            data, saved_stat = saved[path]
+            if stat['mzxid'] != saved_stat['mzxid']:
+                changed.append(path)
+            self._lock.acquire()
+            try:
+                self._nodes[path] = _TreeNode(data, stat, children)
+            finally:
+                self._lock.release()
+            for child in children:
+                if child not in saved_children.get(path, ()):
+                    added.append(join_path(path, child))
+
+        # the data watch is set already
+        for path, future in pipeline(self._connection.get_async, changed, window):
+            try:
+                data, stat = future.result()
+            except zookeeper.NoNodeException:
+                continue
+            self._lock.acquire()
+            try:
+                node = self._nodes[path]
+                node.data = data
+                node.stat = stat
+            finally:
+                self._lock.release()
+        logger.debug('Reconciled %d nodes of %s, %d changed' % (len(self._nodes), self._path, len(changed)))
+
+        # drop nodes, whose parent was replaced meanwhile
+        for path in sorted(self._nodes):
+            if path != self._path and (path[:path.rfind('/')] or '/') not in self._nodes:
+                self._nodes.pop(path)
+
+        for path in sorted(self._nodes):
+            for observer in list(self.observers):
+                observer.node_added(path, self._nodes[path].data)
+        for path in added:
+            self._load(path)
+
+    def _remove(self, path):
+        '''Drops the subtree of path'''
+        removed = []
+        self._lock.acquire()
+        try:
+            pending = [path]
+            while pending:
+                node_path = pending.pop()
+                node = self._nodes.pop(node_path, None)
+                if node is None:
+                    continue
+                removed.append(node_path)
+                pending.extend(join_path(node_path, child) for child in node.children)
+            parent = self._nodes.get(path[:path.rfind('/')] or '/')
+            if parent is not None and path != self._path:
+                parent.children.discard(path[path.rfind('/') + 1:])
+        finally:
+            self._lock.release()
+        for node_path in reversed(removed):
+            for observer in list(self.observers):
+                observer.node_removed(node_path)
+        if path == self._path:
+            # wait for the root to come back
+            self._load(path)
+
+    def _update(self, path):
+        '''Reads the changed data of path'''
+        if path not in self._nodes:
+            return
+        try:
+            data, stat = self._connection.get(path, self._watcher)
+        except zookeeper.NoNodeException:
+            return self._remove(path)
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(path)
+            if node is None or node.stat['mzxid'] == stat['mzxid']:
+                return
+            node.data = data
+            node.stat = stat
+        finally:
+            self._lock.release()
+        for observer in list(self.observers):
+            observer.node_updated(path, data)
+
+    def _update_children(self, path):
+        '''Reads the changed children of path, reads the added subtrees and
+        drops the removed ones
+        '''
+        if path not in self._nodes:
+            return
+        try:
+            children = set(self._connection.get_children(path, self._watcher))
+        except zookeeper.NoNodeException:
+            return self._remove(path)
+        self._lock.acquire()
+        try:
+            node = self._nodes.get(path)
+            if node is None:
+                return
+            added = children - node.children
+            removed = node.children - children
+            node.children = children
+        finally:
+            self._lock.release()
+        for child in removed:
+            self._remove(join_path(path, child))
+        for child in sorted(added):
+            self._load(join_path(path, child))
+
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
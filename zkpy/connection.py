@@ -6,10 +6,12 @@ Created on 19.08.2010
 '''
 
 from functools import wraps
-from zkpy import zk_retry_operation
-from zkpy.utils import enum
+from zkpy import zk_retry_operation, RetryOperationError
+from zkpy.future import Future, gather, pipeline
+from zkpy.utils import enum, join_path
 import logging
 import threading
+import time
 import zookeeper
 
 
@@ -47,15 +49,40 @@ class Connection(object):
             ])
 
 
-    def __init__(self, servers, timeout):
+    # module implementing the zookeeper calls
+    _zk = zookeeper
+
+    # calls taking a watcher as second argument
+    __watching_functions = set(['exists', 'get', 'get_children'])
+
+    def __init__(self, servers, timeout, backend = None, executor = None):
         '''Creates a new Connection object.
 
         :param servers: either a python list or a comma (',')
                         sepparated list of  zookeper servers
         :param timeout: timeout in seconds after connection initialisation fails
+        :param backend: object providing the calls of the zookeeper module
+                        (default: zookeeper). See zkpy.testing.FakeZookeeper
+        :param executor: zkpy.dispatch.DispatchExecutor running the watchers
+                         and the callbacks of the futures. Events of a path
+                         are delivered in order, session events in order with
+                         the future callbacks of the session. By default,
+                         watchers run on the thread of the zookeeper client
+                         and a slow watcher delays all other events and
+                         completions. The executor may be shared by several
+                         connections and is not shut down by close().
         '''
 
         # set up members
+        if backend is not None:
+            self._zk = backend
+        self._executor = executor
+        # set up watch queue. The tuple is replaced on changes, so that
+        # events are dispatched without copying it
+        self._watchers = ()
+        self._watchers_lock = threading.Lock()
+        # path indexed subscriptions, created by the first subscribe()
+        self._registry = None
         if isinstance(servers, basestring):
             self._servers = [server.strip() for server in servers.split(',')]
         else:
@@ -66,16 +93,17 @@ class Connection(object):
         # connect
         self.connect(self._timeout)
 
-        # set up watch queu
-        self._watchers = set()
-
 
     def __del__(self):
         '''Makes sure, that the connection is not left open'''
         logger.debug('ConnectionWatcher: __del__')
-        if self._handle and zookeeper.state(self._handle) == zookeeper.CONNECTED_STATE:
-            self.logger.warn('Closing open zookeeper connection')
-            self.close()
+        try:
+            if self._handle and self._zk.state(self._handle) == zookeeper.CONNECTED_STATE:
+                self.logger.warn('Closing open zookeeper connection')
+                self.close()
+        except zookeeper.ZooKeeperException:
+            # handle was already closed
+            pass
 
 
     def __global_watch(self, handle, type, state, path):
@@ -87,9 +115,20 @@ class Connection(object):
         if self._handle != handle:
             raise RuntimeError('Inconsistend handles!')
 
-        # copy list: watchers might remove themselve during this call...
-        for watcher in list(self._watchers):
+        if self._executor is not None:
+            self._executor.submit(self._dispatch_key(path),
+                                  self.__notify_watchers, type, state, path)
+        else:
+            self.__notify_watchers(type, state, path)
+
+    def __notify_watchers(self, type, state, path):
+        # watchers might remove themselve during this call, which replaces
+        # the tuple
+        for watcher in self._watchers:
             watcher(type, state, path)
+        registry = self._registry
+        if registry is not None:
+            registry.dispatch(type, state, path)
 
         #TODO: handle expiration
 
@@ -105,21 +144,43 @@ class Connection(object):
 #            raise AttributeError
 
         # try to the the wrapped call from the zookeeper package
-        wrapped = getattr(zookeeper, call)
+        wrapped = getattr(self._zk, call)
 
         # if it is not a method/function
         if not hasattr(wrapped, '__call__'):
             raise AttributeError
 
         # create and return a wrapper function (http://gael-varoquaux.info/blog/?p=120)s
+        watching = call in self.__watching_functions
+
         @wraps(wrapped)
         def wrapper(*args, **kwargs):
+            if watching and self._executor is not None:
+                if len(args) > 1:
+                    args = (args[0], self._dispatching(args[1])) + args[2:]
+                elif 'watcher' in kwargs:
+                    kwargs['watcher'] = self._dispatching(kwargs['watcher'])
             #logger.debug('calling %s(%s, %s)' % (call, ', '.join(str(arg) for arg in args), ', '.join('%s=%s' % (k,v) for k,v in kwargs.items())))
             return wrapped(self._handle, *args, **kwargs)
 
         return wrapper
 
 
+    @property
+    def handle(self):
+        '''The zookeeper handle of this connection'''
+        return self._handle
+
+    def request_counters(self):
+        '''Returns a copy of the backend's request counts (call name ->
+        count), or None if the backend does not count its requests, like
+        the zookeeper module. See zkpy.testing.FakeZookeeper.
+        '''
+        counters = getattr(self._zk, 'counters', None)
+        if counters is None:
+            return None
+        return dict(counters)
+
     def set_watcher(self, watcher):
         '''Overwrite zookeeper.set_watcher method and forwards to
         add_global_watcher
@@ -127,22 +188,85 @@ class Connection(object):
         self.add_global_watcher(watcher)
 
 
+    def _dispatch_key(self, path):
+        '''Executor key of the events of path. The session events and the
+        future callbacks of the connection have the key of the path ''.
+        '''
+        return (id(self), path)
+
+    def _dispatching(self, watcher):
+        '''Wraps a watcher of a single call, so that it runs on the executor
+        in order with the other events of its path.
+        '''
+        if watcher is None or self._executor is None:
+            return watcher
+        executor = self._executor
+        def dispatching_watcher(handle, type, state, path):
+            executor.submit(self._dispatch_key(path), watcher, handle, type, state, path)
+        return dispatching_watcher
+
+    def _future(self, timeout):
+        '''Returns the future of an asynchronous call, whose callbacks run on
+        the executor in order with the session events.
+        '''
+        if self._executor is None:
+            return Future(timeout)
+        return Future(timeout, self._executor, self._dispatch_key(''))
+
+    def subscribe(self, path, callback, types = None, prefix = False,
+                  coalesce = None):
+        '''Calls callback(type, state, path) for the events of a path.
+        Unlike global watchers, the callback is only called for the events
+        it subscribed to, and the watches of a path are set once on the
+        server for all of its subscribers. See zkpy.watches.WatchRegistry.
+        :param path: Node path, '' for session events
+        :param types: Iterable of EventType values to deliver, None for all
+        :param prefix: If True, the events of all nodes below path are
+                       delivered as well. Prefix subscriptions set no watches.
+        :param coalesce: Time window in seconds. The node events of a path
+                         are delivered once per window, the last one only.
+                         None delivers each event.
+        :returns: Subscription, call its cancel() method to unsubscribe
+        '''
+        self._watchers_lock.acquire()
+        try:
+            if self._registry is None:
+                from zkpy.watches import WatchRegistry
+                self._registry = WatchRegistry(self)
+        finally:
+            self._watchers_lock.release()
+        return self._registry.subscribe(path, callback, types, prefix, coalesce)
+
+    def unsubscribe(self, subscription):
+        '''Removes a subscription returned by subscribe()'''
+        subscription.cancel()
+
     def add_global_watcher(self, watcher):
         '''Adds a watcher to  global events'''
-        self._watchers.add(watcher)
+        self._watchers_lock.acquire()
+        try:
+            if watcher not in self._watchers:
+                self._watchers = self._watchers + (watcher,)
+        finally:
+            self._watchers_lock.release()
 
     def remove_global_watcher(self, watcher):
         '''Removes a formerly added watcher.
         Does nothing, if the watcher is not in the pool
         '''
+        self._watchers_lock.acquire()
         try:
-            self._watchers.remove(watcher)
-        except KeyError:
-            self.logger.warn('remove_global_watcher: %s is not in the oberserver pool' % watcher)
+            if watcher in self._watchers:
+                self._watchers = tuple(registered for registered in self._watchers
+                                       if registered != watcher)
+                return
+        finally:
+            self._watchers_lock.release()
+        self.logger.warn('remove_global_watcher: %s is not in the oberserver pool' % watcher)
 
     def recv_timeout(self):
         '''Returns zookeeper's recv timout in seconds.'''
-        return zookeeper.recv_timeout(self._handle) / 1000.
+        return self._zk.recv_timeout(self._handle) / 1000.
 
     def add_auth(self, scheme, credentials):
         '''Specifies the connection credentials
@@ -169,7 +293,7 @@ class Connection(object):
 
         # call method
         logger.debug('Adding auth')
-        zookeeper.add_auth(self._handle, scheme, credentials, auth_watch)
+        self._zk.add_auth(self._handle, scheme, credentials, auth_watch)
 
         # wait for completion
         wait_time = self.recv_timeout()
@@ -217,18 +341,18 @@ class Connection(object):
 
         # try to connect
         condition.acquire()
-        self._handle = zookeeper.init(
+        self._handle = self._zk.init(
 			','.join(self._servers),
             connection_watch,
             self._timeout * 1000)
         condition.wait(self._timeout)
         condition.release()
 
-        if zookeeper.state(self._handle) != zookeeper.CONNECTED_STATE:
-            zookeeper.close(self._handle)
+        if self._zk.state(self._handle) != zookeeper.CONNECTED_STATE:
+            self._zk.close(self._handle)
             raise RuntimeError(
                 'unable to connect to %s ' % (' or '.join(self._servers)))
-        zookeeper.set_watcher(self._handle, self.__global_watch)
+        self._zk.set_watcher(self._handle, self.__global_watch)
 
 
     def close(self):
@@ -240,16 +364,18 @@ class Connection(object):
             return
 
         logger.debug('closing connection')
+        if self._registry is not None:
+            self._registry.close()
 
         try:
-            _state = zookeeper.state(self._handle)
+            _state = self._zk.state(self._handle)
         except zookeeper.ZooKeeperException:
             logger.warn('Connection is already closed')
             return True
 
         for _ in range(3):
             try:
-                return zookeeper.close(self._handle) == zookeeper.OK
+                return self._zk.close(self._handle) == zookeeper.OK
             except: #zookeeper.ConnectionLossException:
                 logger.info('Got exception while closing. Retrying...')
         logger.error('Failed closing the zookeeper connection')
@@ -284,10 +410,247 @@ class Connection(object):
                 if parent_path:
                     self.ensure_path_exists(parent_path, '', acl, recursive)
 
-            # create this node
-            self.create(path, data, acl, NodeCreationMode.Persistent)
+            # create this node. Somebody else might have been faster
+            try:
+                self.create(path, data, acl, NodeCreationMode.Persistent)
+            except zookeeper.NodeExistsException:
+                pass
             return True
 
+    def _call_async(self, future, call, *args):
+        '''Issues an asynchronous zookeeper call. Errors raised while
+        submitting the request fail the future instead of being raised.
+        '''
+        try:
+            call(self._handle, *args)
+        except zookeeper.ZooKeeperException as e:
+            future.set_exception(e)
+        return future
+
+    def create_async(self, path, data, acl, flags = 0, timeout = None):
+        '''Asynchronous create(). The future's result is the path of the
+        created node.
+        :param timeout: deadline of this call in seconds
+        '''
+        future = self._future(timeout)
+        def completion(handle, rc, value):
+            _complete_future(future, rc, value)
+        return self._call_async(future, self._zk.acreate,
+                                path, data, acl, flags, completion)
+
+    def delete_async(self, path, version = -1, timeout = None):
+        '''Asynchronous delete(). The future's result is zookeeper.OK'''
+        future = self._future(timeout)
+        def completion(handle, rc):
+            _complete_future(future, rc, rc)
+        return self._call_async(future, self._zk.adelete,
+                                path, version, completion)
+
+    def set_async(self, path, data, version = -1, timeout = None):
+        '''Asynchronous set(). The future's result is the new node stat'''
+        future = self._future(timeout)
+        def completion(handle, rc, stat):
+            _complete_future(future, rc, stat)
+        return self._call_async(future, self._zk.aset,
+                                path, data, version, completion)
+
+    def exists_async(self, path, watcher = None, timeout = None):
+        '''Asynchronous exists(). The future's result is the node stat, or
+        None if the node does not exist.
+        '''
+        future = self._future(timeout)
+        def completion(handle, rc, stat):
+            if rc == zookeeper.NONODE:
+                future.set_result(None)
+            else:
+                _complete_future(future, rc, stat)
+        return self._call_async(future, self._zk.aexists,
+                                path, self._dispatching(watcher), completion)
+
+    def get_async(self, path, watcher = None, timeout = None):
+        '''Asynchronous get(). The future's result is a (data, stat) tuple'''
+        future = self._future(timeout)
+        def completion(handle, rc, value, stat):
+            _complete_future(future, rc, (value, stat))
+        return self._call_async(future, self._zk.aget,
+                                path, self._dispatching(watcher), completion)
+
+    def get_children_async(self, path, watcher = None, timeout = None):
+        '''Asynchronous get_children(). The future's result is the list of
+        child names.
+        '''
+        future = self._future(timeout)
+        def completion(handle, rc, children):
+            _complete_future(future, rc, children)
+        return self._call_async(future, self._zk.aget_children,
+                                path, self._dispatching(watcher), completion)
+
+    def _pipelined(self, submit, items, window, retry_count = 10, retry_delay = 0.5):
+        '''Calls submit(item) for all items with at most window requests in
+        flight. Requests failing with a connection loss are retried.
+        Returns a list of (item, future) tuples of the completed requests.
+        '''
+        completed = []
+        for _attempt_count in range(retry_count):
+            lost = []
+            for item, future in pipeline(submit, items, window):
+                if isinstance(future.exception(), zookeeper.ConnectionLossException):
+                    lost.append(item)
+                else:
+                    completed.append((item, future))
+            if not lost:
+                return completed
+            items = lost
+            time.sleep(retry_delay)
+        raise RetryOperationError('Could not execute %d requests. Retried for %d times' % (len(items), retry_count))
+
+    def ensure_tree(self, paths, data, acl, window = 1000):
+        '''Creates all given paths including their parent nodes. All nodes of
+        a tree level are created in parallel, thus the whole tree costs about
+        one round trip per level (and window). Existing nodes are left
+        untouched.
+        :param paths: iterable of node paths
+        :param data: Znode data of the given paths. Parent nodes which are
+                     not in paths are created with empty data.
+        :param acl: Znode access control list of all created nodes
+        :param window: maximal number of requests in flight
+        :returns: number of created nodes
+        '''
+        # group all paths and their parents by depth
+        levels = {}
+        requested = set()
+        for path in paths:
+            path = path.rstrip('/')
+            requested.add(path)
+            while path:
+                levels.setdefault(path.count('/'), set()).add(path)
+                path = path[:path.rfind('/')]
+
+        def create(path):
+            node_data = ''
+            if path in requested:
+                node_data = data
+            return self.create_async(path, node_data, acl, NodeCreationMode.Persistent)
+
+        created = 0
+        for depth in sorted(levels):
+            for _path, future in self._pipelined(create, sorted(levels[depth]), window):
+                exception = future.exception()
+                if exception is None:
+                    created += 1
+                elif not isinstance(exception, zookeeper.NodeExistsException):
+                    raise exception
+        return created
+
+    def walk(self, path, watcher = None, window = 1000):
+        '''Reads path and its subtree level by level. All nodes of a tree
+        level are read in parallel.
+        Yields a (path, data, stat, children) tuple per node. Nodes which are
+        deleted during the walk are skipped.
+        :param watcher: optional watcher set on the data and the children of
+                        every node
+        :param window: maximal number of requests in flight
+        '''
+        def read(node_path):
+            return gather([self.get_async(node_path, watcher),
+                           self.get_children_async(node_path, watcher)])
+
+        level = [path]
+        while level:
+            next_level = []
+            for node_path, future in self._pipelined(read, level, window):
+                try:
+                    (data, stat), children = future.result()
+                except zookeeper.NoNodeException:
+                    continue
+                next_level.extend(join_path(node_path, child) for child in sorted(children))
+                yield node_path, data, stat, children
+            level = next_level
+
+    def delete_recursive(self, path, window = 1000, retry_count = 3):
+        '''Deletes path and its whole subtree, leaves first. All nodes of a
+        tree level are deleted in parallel.
+        If nodes are added concurrently, the deletion is retried.
+        :param window: maximal number of requests in flight
+        :returns: number of deleted nodes
+        '''
+        deleted = 0
+        for _attempt_count in range(retry_count):
+            # collect the tree levels
+            levels = []
+            level = [path]
+            while level:
+                levels.append(level)
+                next_level = []
+                for node_path, future in self._pipelined(self.get_children_async, level, window):
+                    try:
+                        children = future.result()
+                    except zookeeper.NoNodeException:
+                        continue
+                    next_level.extend(join_path(node_path, child) for child in children)
+                level = next_level
+
+            # delete the leaves first
+            not_empty = False
+            for level in reversed(levels):
+                for _node_path, future in self._pipelined(self.delete_async, level, window):
+                    exception = future.exception()
+                    if exception is None:
+                        deleted += 1
+                    elif isinstance(exception, zookeeper.NotEmptyException):
+                        not_empty = True
+                    elif not isinstance(exception, zookeeper.NoNodeException):
+                        raise exception
+            if not not_empty:
+                return deleted
+        raise RuntimeError('Could not delete %s. Nodes were added concurrently' % path)
+
+
+# maps zookeeper's return codes to the names of its exceptions
+_ERROR_EXCEPTIONS = {
+    'SYSTEMERROR'               : 'SystemErrorException',
+    'RUNTIMEINCONSISTENCY'      : 'RuntimeInconsistencyException',
+    'DATAINCONSISTENCY'         : 'DataInconsistencyException',
+    'CONNECTIONLOSS'            : 'ConnectionLossException',
+    'MARSHALLINGERROR'          : 'MarshallingErrorException',
+    'UNIMPLEMENTED'             : 'UnimplementedException',
+    'OPERATIONTIMEOUT'          : 'OperationTimeoutException',
+    'BADARGUMENTS'              : 'BadArgumentsException',
+    'INVALIDSTATE'              : 'InvalidStateException',
+    'APIERROR'                  : 'ApiErrorException',
+    'NONODE'                    : 'NoNodeException',
+    'NOAUTH'                    : 'NoAuthException',
+    'BADVERSION'                : 'BadVersionException',
+    'NOCHILDRENFOREPHEMERALS'   : 'NoChildrenForEphemeralsException',
+    'NODEEXISTS'                : 'NodeExistsException',
+    'NOTEMPTY'                  : 'NotEmptyException',
+    'SESSIONEXPIRED'            : 'SessionExpiredException',
+    'INVALIDCALLBACK'           : 'InvalidCallbackException',
+    'INVALIDACL'                : 'InvalidACLException',
+    'AUTHFAILED'                : 'AuthFailedException',
+    'CLOSING'                   : 'ClosingException',
+    'NOTHING'                   : 'NothingException',
+    'SESSIONMOVED'              : 'SessionMovedException',
+}
+
+def error_to_exception(rc):
+    '''Returns the zookeeper exception for the given return code'''
+    for code_name, exception_name in _ERROR_EXCEPTIONS.iteritems():
+        if getattr(zookeeper, code_name, None) == rc:
+            exception_type = getattr(zookeeper, exception_name,
+                                     zookeeper.ZooKeeperException)
+            break
+    else:
+        exception_type = zookeeper.ZooKeeperException
+    return exception_type(zookeeper.zerror(rc))
+
+def _complete_future(future, rc, result):
+    '''Completes a future with the result of a completion callback'''
+    if rc == zookeeper.OK:
+        future.set_result(result)
+    else:
+        future.set_exception(error_to_exception(rc))
+
 
 
 
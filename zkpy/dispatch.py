@@ -0,0 +1,67 @@
+'''
+Created on 16.10.2010
+
+@author: luk
+'''
+
+from Queue import Queue
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+class DispatchExecutor(object):
+    '''Runs callbacks on a pool of worker threads.
+    Callbacks are submitted with a key, e.g. the node path of a watch event.
+    Each key is served by one worker only, thus the callbacks of a key run
+    one after the other in the order of submission, while callbacks of other
+    keys may run in parallel.
+    '''
+
+    def __init__(self, threads = 4, name = 'zkpy-dispatch'):
+        '''Executor construction.
+        :param threads: Number of worker threads
+        :param name: Name prefix of the worker threads
+        '''
+        self._queues = []
+        self._workers = []
+        for index in range(threads):
+            queue = Queue()
+            worker = threading.Thread(target=self._run, args=(queue,),
+                                      name='%s-%d' % (name, index))
+            worker.setDaemon(True)
+            self._queues.append(queue)
+            self._workers.append(worker)
+            worker.start()
+
+    def submit(self, key, callback, *args):
+        '''Queues callback(*args) for the worker serving key'''
+        self._queues[hash(key) % len(self._queues)].put((callback, args))
+
+    def shutdown(self, wait = True):
+        '''Stops the workers, once they ran the queued callbacks'''
+        for queue in self._queues:
+            queue.put(None)
+        if wait:
+            for worker in self._workers:
+                if worker is not threading.currentThread():
+                    worker.join()
+
+    def _run(self, queue):
+        while True:
+            task = queue.get()
+            if task is None:
+                return
+            callback, args = task
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception('Callback %s failed' % callback)
+
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,242 @@
+'''
+Created on 16.10.2010
+
+@author: luk
+'''
+
+from zkpy.connection import EventType, KeeperState, NodeCreationMode
+from zkpy.lock import Lock
+from zkpy.utils import join_path
+import logging
+import threading
+import time
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+class _Candidate(Lock):
+    '''Candidate node of a LeaderElection. The candidates queue up like lock
+    nodes: the first one is the leader, all others watch their predecessor
+    only. The leader node of the election is no candidate.
+    '''
+
+    def _id_to_node_prefix(self, id):
+        return 'candidate-%s-' % str(id)
+
+    def _index_predecessors(self, children = None):
+        if children is None:
+            children = self._connection.get_children(self._path)
+        candidates = [child for child in children if child.startswith('candidate-')]
+        return Lock._index_predecessors(self, candidates)
+
+
+class LeaderElection(object):
+    '''Leader election.
+    Candidates join the election with some data, e.g. their address. The
+    elected leader publishes its data in the ephemeral node <path>/leader.
+    On failover, only the next candidate gets notified of its predecessor's
+    leave. Only following election objects watch the leader node, so a
+    failover notifies just the processes interested in the leader's
+    identity, and each of their connections only once.
+
+    Observers need to implement three methods:
+     - elected(): this candidate became the leader
+     - deposed(): this candidate is not the leader anymore
+     - leader_changed(data): a new leader was published, data is None if
+       there is no leader at the moment
+    '''
+
+    def __init__(self, connection, path, data = '', observer = None,
+                 follow = False):
+        '''Election construction.
+        :param connection: The zkpy connection
+        :param path: Parent node of the candidate and leader nodes. Needs to
+                     exist. Note: children will have the same ACL as this node
+        :param data: Data published, when this candidate gets elected
+        :param observer: Election observer object
+        :param follow: If True, the leader node is watched: leader,
+                       handover_time and leader_changed() follow the current
+                       leader. Otherwise leader reads the node.
+        '''
+        self._connection = connection
+        self._path = path
+        self._leader_path = join_path(path, 'leader')
+        self.data = data
+        self.observers = set()
+        if observer:
+            self.register_observer(observer)
+
+        self._candidate = _Candidate(connection, path, self)
+        self._leader = None
+        self._leader_czxid = None
+        self._vacant_since = None
+        self._is_leader = False
+        self.handover_time = None
+        self._mutex = threading.RLock()
+
+        self._leader_subscription = None
+        self._session_subscription = None
+        if follow:
+            # the connection watches the leader node once for all its
+            # subscribers and sets the watch again on reconnect
+            self._leader_subscription = connection.subscribe(
+                    self._leader_path, self._leader_watcher,
+                    [EventType.NodeCreated, EventType.NodeDeleted,
+                     EventType.NodeDataChanged])
+            # changes may have been missed while disconnected
+            self._session_subscription = connection.subscribe(
+                    '', self._session_watcher, [EventType.NoneType])
+            self._read_leader()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def leader(self):
+        '''Data of the current leader or None'''
+        if self._leader_subscription is None:
+            try:
+                return self._connection.get(self._leader_path)[0]
+            except zookeeper.NoNodeException:
+                return None
+        return self._leader
+
+    def register_observer(self, observer):
+        '''Registers an election observer'''
+        self.observers.add(observer)
+
+    def join(self):
+        '''Enters the election as a candidate.
+        Returns True, if this candidate got elected at once.
+        '''
+        return self._candidate.acquire()
+
+    def resign(self):
+        '''Leaves the election. A leader removes its leader node first, so
+        that the next candidate can publish its own.
+        '''
+        self._mutex.acquire()
+        try:
+            if self._is_leader:
+                try:
+                    self._connection.delete(self._leader_path)
+                except zookeeper.NoNodeException:
+                    logger.warn('Leader node %s is already gone' % self._leader_path)
+        finally:
+            self._mutex.release()
+        if self._candidate.id:
+            self._candidate.release()
+
+    def is_leader(self):
+        '''Returns True, if this candidate is the leader'''
+        return self._is_leader and self._candidate.is_owner()
+
+    def close(self):
+        '''Stops following the leader. Does not resign.'''
+        if self._leader_subscription is not None:
+            self._leader_subscription.cancel()
+            self._session_subscription.cancel()
+
+    def _read_leader(self):
+        '''Reads the leader node'''
+        self._mutex.acquire()
+        try:
+            try:
+                data, stat = self._connection.get(self._leader_path)
+            except zookeeper.NoNodeException:
+                data, stat = None, None
+            except zookeeper.ZooKeeperException as e:
+                # the next Connected event reads again
+                logger.warn('Could not read the leader of %s: %s' % (self._path, e))
+                return
+            self._set_leader(data, stat)
+        finally:
+            self._mutex.release()
+
+    def _leader_watcher(self, type, state, path):
+        if type == EventType.NodeDeleted:
+            self._mutex.acquire()
+            try:
+                if self._vacant_since is None:
+                    self._vacant_since = time.time()
+            finally:
+                self._mutex.release()
+        self._read_leader()
+
+    def _session_watcher(self, type, state, path):
+        if state == KeeperState.Connected:
+            self._read_leader()
+
+    def _set_leader(self, data, stat):
+        self._mutex.acquire()
+        try:
+            czxid = stat and stat['czxid']
+            if czxid == self._leader_czxid:
+                return
+            self._leader_czxid = czxid
+            self._leader = data
+            if stat is None:
+                if self._vacant_since is None:
+                    self._vacant_since = time.time()
+            elif self._vacant_since is not None:
+                self.handover_time = time.time() - self._vacant_since
+                self._vacant_since = None
+                logger.debug('New leader of %s after %.3f seconds' % (self._path, self.handover_time))
+            for observer in list(self.observers):
+                observer.leader_changed(data)
+        finally:
+            self._mutex.release()
+
+    def _publish(self):
+        '''Creates the leader node. A leftover node of another session is
+        replaced, as holding the first candidate node makes us the leader.
+        '''
+        acls = self._candidate._acls
+        for _retry in range(3):
+            try:
+                self._connection.create(self._leader_path, self.data, acls,
+                                        NodeCreationMode.Ephemeral)
+                return
+            except zookeeper.NodeExistsException:
+                stat = self._connection.exists(self._leader_path)
+                session_id, _passwd = self._connection.client_id()
+                if stat and stat['ephemeralOwner'] == session_id:
+                    return
+                logger.warn('Replacing the leader node of a former leader')
+                try:
+                    self._connection.delete(self._leader_path)
+                except zookeeper.NoNodeException:
+                    pass
+        raise RuntimeError('Could not publish the leader node %s' % self._leader_path)
+
+    # candidate lock watcher
+
+    def lock_acquired(self):
+        self._mutex.acquire()
+        try:
+            self._publish()
+            self._is_leader = True
+            for observer in list(self.observers):
+                observer.elected()
+        finally:
+            self._mutex.release()
+
+    def lock_released(self):
+        self._mutex.acquire()
+        try:
+            if not self._is_leader:
+                return
+            self._is_leader = False
+            for observer in list(self.observers):
+                observer.deposed()
+        finally:
+            self._mutex.release()
+
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -7,3 +7,6 @@ Created on 01.10.2010
 
 class NoNodeException(Exception):
     pass
+
+class TimeoutException(Exception):
+    pass
@@ -0,0 +1,271 @@
+'''
+Created on 12.10.2010
+
+@author: luk
+'''
+
+from collections import deque
+from zkpy.exceptions import TimeoutException
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+class _DeadlineTimer(object):
+    '''Fails futures, once their deadline has passed. A single thread serves
+    the futures of all connections, it is started with the first deadline.
+    '''
+
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def add(self, future):
+        self._condition.acquire()
+        try:
+            heapq.heappush(self._heap, (future.deadline, self._order.next(), future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='zkpy-deadlines')
+                self._thread.setDaemon(True)
+                self._thread.start()
+            if self._heap[0][2] is future:
+                self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        self._condition.acquire()
+        try:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                deadline, _order, future = self._heap[0]
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._heap)
+                if future._done:
+                    continue
+                self._condition.release()
+                try:
+                    future._check_deadline()
+                finally:
+                    self._condition.acquire()
+        finally:
+            self._condition.release()
+
+_deadline_timer = _DeadlineTimer()
+
+
+class Future(object):
+    '''Result of an asynchronous zookeeper call.
+
+    The future is completed from zookeeper's completion thread. If a timeout
+    was given on construction, the future fails with a TimeoutException as
+    soon as its deadline has passed without a result (a late result is then
+    ignored). Callbacks of a future failed this way run on the deadline
+    timer's thread, unless an executor is given.
+    '''
+
+    def __init__(self, timeout = None, executor = None, key = None):
+        ''':param timeout: per call deadline in seconds (None: no deadline)
+        :param executor: zkpy.dispatch.DispatchExecutor running the callbacks
+                         (None: the thread completing the future runs them)
+        :param key: executor key of the callbacks
+        '''
+        self._executor = executor
+        self._key = key
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        if timeout is None:
+            self.deadline = None
+        else:
+            self.deadline = time.time() + timeout
+            _deadline_timer.add(self)
+
+    def __repr__(self):
+        if not self._done:
+            return '<Future pending>'
+        if self._exception is not None:
+            return '<Future failed: %r>' % self._exception
+        return '<Future result: %r>' % (self._result,)
+
+    def _check_deadline(self):
+        '''Fails the future, if its deadline has passed'''
+        if not self._done and self.deadline is not None and time.time() >= self.deadline:
+            self.set_exception(TimeoutException('Deadline exceeded'))
+
+    def _complete(self, result, exception):
+        '''Completes the future and runs the callbacks.
+        Returns False, if the future was completed already.
+        '''
+        self._condition.acquire()
+        try:
+            if self._done:
+                return False
+            self._result = result
+            self._exception = exception
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+        for callback in callbacks:
+            if self._executor is not None:
+                self._executor.submit(self._key, self._run_callback, callback)
+            else:
+                self._run_callback(callback)
+        return True
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logger.exception('Future callback %s failed' % callback)
+
+    def set_result(self, result):
+        '''Sets the result. Returns False, if the future was already done.'''
+        return self._complete(result, None)
+
+    def set_exception(self, exception):
+        '''Fails the future. Returns False, if the future was already done.'''
+        return self._complete(None, exception)
+
+    def done(self):
+        '''Returns True, if the future has a result or failed.'''
+        self._check_deadline()
+        return self._done
+
+    def add_done_callback(self, callback):
+        '''Calls callback(future) when the future is done. If it is done
+        already, the callback is called immediately.
+        Note: callbacks usually run on zookeeper's completion thread (or the
+        connection's executor) and should not block.
+        '''
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._condition.release()
+        self._run_callback(callback)
+
+    def _wait(self, timeout):
+        '''Waits until the future is done, the timeout elapsed or the deadline
+        passed. Raises a TimeoutException in the second case.
+        '''
+        until = None
+        if timeout is not None:
+            until = time.time() + timeout
+        if self.deadline is not None and (until is None or self.deadline < until):
+            until = self.deadline
+
+        self._condition.acquire()
+        try:
+            while not self._done:
+                if until is None:
+                    self._condition.wait()
+                    continue
+                remaining = until - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        finally:
+            self._condition.release()
+
+        self._check_deadline()
+        if not self._done:
+            raise TimeoutException('Future not done within %.2f seconds' % timeout)
+
+    def result(self, timeout = None):
+        '''Returns the result of the call, or raises its exception.
+        :param timeout: seconds to wait (None: wait until the deadline)
+        '''
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout = None):
+        '''Returns the exception of the call, or None if it succeeded.'''
+        self._wait(timeout)
+        return self._exception
+
+
+def wait(futures, timeout = None):
+    '''Waits until all futures are done.
+    Returns True, if all futures are done.
+    '''
+    until = None
+    if timeout is not None:
+        until = time.time() + timeout
+    for future in futures:
+        remaining = None
+        if until is not None:
+            remaining = max(0, until - time.time())
+        try:
+            future.exception(remaining)
+        except TimeoutException:
+            return False
+    return True
+
+def gather(futures):
+    '''Returns a future, whose result is the list of the futures' results.
+    It fails with the first exception of one of the futures.
+    '''
+    futures = list(futures)
+    gathered = Future()
+    if not futures:
+        gathered.set_result([])
+        return gathered
+
+    pending = [len(futures)]
+    lock = threading.Lock()
+    def callback(future):
+        exception = future.exception()
+        if exception is not None:
+            gathered.set_exception(exception)
+            return
+        lock.acquire()
+        try:
+            pending[0] -= 1
+            finished = pending[0] == 0
+        finally:
+            lock.release()
+        if finished:
+            gathered.set_result([f.result() for f in futures])
+
+    for future in futures:
+        future.add_done_callback(callback)
+    return gathered
+
+def pipeline(submit, items, window):
+    '''Calls submit(item) for each item, which needs to return a future. At
+    most window futures are pending at a time. Yields (item, future) tuples in
+    the order of the items, once the future is done.
+    '''
+    in_flight = deque()
+    for item in items:
+        in_flight.append((item, submit(item)))
+        if len(in_flight) >= window:
+            item, future = in_flight.popleft()
+            future.exception()
+            yield item, future
+    while in_flight:
+        item, future = in_flight.popleft()
+        future.exception()
+        yield item, future
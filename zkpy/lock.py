@@ -6,14 +6,58 @@ Created on 20.08.2010
 
 from zkpy import zk_retry_operation
 from zkpy.connection import KeeperState, NodeCreationMode, EventType
+from zkpy.future import wait
+from zkpy.utils import join_path
+import heapq
 import logging
-import operator
+import threading
+import time
 import zookeeper
 from zkpy.exceptions import NoNodeException
 
 
 logger = logging.getLogger(__name__)
 
+
+def _sequence(name):
+    '''Sequence number of a lock node. nodeformat: <prefix>-<sequence number>'''
+    return int(name[-10:])
+
+
+class _SequenceIndex(object):
+    '''The lock nodes in front of ours, which we might have to wait for.
+    They are kept in a heap, so that only the nodes actually checked get
+    ordered, starting with the nearest one.
+    '''
+
+    def __init__(self, nodes):
+        ''':param nodes: (sequence number, name) tuples'''
+        self._heap = [(-seq, name) for seq, name in nodes]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def nearest(self):
+        '''Returns the name of the nearest node in front of ours or None'''
+        if self._heap:
+            return self._heap[0][1]
+        return None
+
+    def discard(self, name):
+        '''Removes the nearest node, if it has the given name'''
+        if self._heap and self._heap[0][1] == name:
+            heapq.heappop(self._heap)
+
+    def truncate(self):
+        '''Removes all nodes but the nearest one'''
+        del self._heap[1:]
+
+    def names(self):
+        '''Returns the names of the nodes'''
+        return [name for _seq, name in self._heap]
+
+
 class Lock(object):
     '''Distributed lock.
     Implements a distributed lock per connection (i.e. creating a lock object
@@ -40,6 +84,18 @@ class Lock(object):
         self._id = None
         self._last_owner = None
         self._watched_neighbor = None
+        self._index = None
+        self._acquired = False
+        # whether the lock is acquired or still queued for
+        self._wanted = False
+        # guards the lock state against the watcher threads
+        self._mutex = threading.RLock()
+        # set, when the lock got acquired or lost
+        self._changed = threading.Event()
+        # whether we watched a node in front of ours
+        self._waited = False
+        # session events, subscribed while the lock is wanted
+        self._session_subscription = None
 
         try:
             _stat, self._acls = self._connection.get_acl(path)
@@ -63,6 +119,52 @@ class Lock(object):
     def _id_to_node_prefix(self, id):
         return 'lock-%s-' % str(id)
 
+    def _set_acquired(self, acquired):
+        self._acquired = acquired
+        if acquired:
+            self._changed.set()
+
+    # An exclusive holder, which had to wait, sets the data of its node. The
+    # successor watching it learns this way, that all nodes in front of the
+    # holder are gone, and acquires the lock without listing the nodes again,
+    # once the holder's node is deleted.
+    _exclusive = True
+
+    def _blocking_nodes(self, predecessors):
+        '''Returns the nodes this lock has to wait for. The lock is acquired,
+        when all of them are gone.
+        :param predecessors: (sequence number, name) tuples of the lock nodes
+                             in front of ours
+        '''
+        return predecessors
+
+    def _neighbor_deleted(self, neighbor):
+        '''Called, when the watched node was deleted. The index still holds
+        the other nodes in front of ours.
+        '''
+        if self._index is not None:
+            self._index.discard(neighbor)
+
+    def _subscribe_session(self):
+        '''Starts receiving session events'''
+        self._mutex.acquire()
+        try:
+            if self._session_subscription is None:
+                self._session_subscription = self._connection.subscribe(
+                        '', self._connection_watcher, [EventType.NoneType])
+        finally:
+            self._mutex.release()
+
+    def _unsubscribe_session(self):
+        '''Stops receiving session events'''
+        self._mutex.acquire()
+        try:
+            if self._session_subscription is not None:
+                self._session_subscription.cancel()
+                self._session_subscription = None
+        finally:
+            self._mutex.release()
+
     def _connection_watcher(self, type, state, path):
         '''Receives global connection events.'''
 
@@ -75,7 +177,10 @@ class Lock(object):
                 logger.warning('Connection expired on NONE lock! (path=%s, last_owner=%s)' % (self._path, self._last_owner))
 
             self._id = None
-            self._connection.remove_global_watcher(self._connection_watcher)
+            self._wanted = False
+            self._set_acquired(False)
+            self._changed.set()
+            self._unsubscribe_session()
             if self.watcher:
                 self.watcher.lock_released()
         elif state == KeeperState.Connecting:
@@ -91,20 +196,10 @@ class Lock(object):
 
 
 
-    def _get_or_create_lock_node(self, prefix):
-        '''Gets or creates the node with the given node name prefix.
+    def _create_lock_node(self, prefix):
+        '''Creates the node with the given node name prefix.
         Returns the full node name (without the path)
         '''
-        # get all children
-        children = self._connection.get_children(self._path)
-
-        # search it, in the children list
-        for child in children:
-            if child.startswith(prefix):
-                logger.debug('Found already existing node %s' % child)
-                return child
-
-        # if not found: create the node
         node = self._connection.create('%s/%s' % (self._path, prefix),
                                 '',
                                 self._acls,
@@ -114,34 +209,172 @@ class Lock(object):
         logger.debug('Created node %s' % node)
         return node_id
 
-    def __smaller_neighbor_watcher(self, handle, type, state, path):
-        if self._id and path[len(self._path)+1:] == self._watched_neighbor:
-            logger.debug('Watcher fired on path: %s state: %s type: %s. Tryin to acquire the lock' % (path, EventType[type], KeeperState[state]))
-            self._lock()
-
+    def _index_predecessors(self, children = None):
+        '''Lists the lock nodes once and indexes the ones in front of ours,
+        which we need to wait for. Returns False, if our node is missing.
+        :param children: Listing of the lock nodes, if already at hand
+        '''
+        if children is None:
+            children = self._connection.get_children(self._path)
+        if self._id not in children:
+            return False
+
+        # another lock object on this connection or a retried create left a
+        # node with our prefix: use the oldest one
+        prefix = self._id[:-10]
+        own = [child for child in children if child.startswith(prefix)]
+        oldest = min(own, key=_sequence)
+        if oldest != self._id:
+            logger.debug('Found already existing node %s' % oldest)
+            try:
+                self._connection.delete('%s/%s' % (self._path, self._id))
+            except zookeeper.NoNodeException:
+                pass
+            self._id = oldest
+
+        # the sequence numbers have a fixed width: compare them as strings
+        # and only parse the ones in front of us
+        own_seq = self._id[-10:]
+        predecessors = [(_sequence(child), child) for child in children
+                        if child[-10:] < own_seq]
+        if predecessors:
+            self._last_owner = min(predecessors)[1]
+        else:
+            self._last_owner = self._id
+        self._index = _SequenceIndex(self._blocking_nodes(predecessors))
+        return True
 
-    def acquire(self):
+    def __smaller_neighbor_watcher(self, handle, type, state, path):
+        # session events are handled by the connection watcher
+        if type == EventType.NoneType:
+            return
+        logger.debug('Watcher fired on path: %s state: %s type: %s. Tryin to acquire the lock' % (path, EventType[type], KeeperState[state]))
+        # the watch may fire before _try_lock noted the watched node: _lock
+        # checks it, once _try_lock is done
+        self._lock(path[len(self._path)+1:], type == EventType.NodeDeleted,
+                   type == EventType.NodeDataChanged)
+
+
+    def acquire(self, blocking = False, timeout = None):
+        '''Acquires the lock.
+        Returns True, if the lock is held. A non-blocking call returns False
+        if the lock is held by someone else, but stays queued: the watcher is
+        notified, when the lock is acquired later on.
+        Like all locks of this module, acquire() does not block by default,
+        unless a timeout is given.
+        :param blocking: Waits until the lock is acquired
+        :param timeout: Maximal time to wait in seconds, None waits forever.
+                        When it passes, the lock node is withdrawn and False
+                        is returned.
+        '''
+        blocking = blocking or timeout is not None
 
         # check, if we need to lock ourself?
         if self.is_owner():
             return True
 
         # register observer
-        self._connection.add_global_watcher(self._connection_watcher)
-        
+        self._subscribe_session()
+        self._wanted = True
+        self._changed.clear()
+
         try:
-            return self._lock()
+            if self._lock():
+                return True
         except:
             # something went wrong, thus we remove the observer
-            self._connection.remove_global_watcher(self._connection_watcher)
+            self._unsubscribe_session()
+            raise
+
+        if not blocking:
+            return False
+
+        # the lock watchers signal us, when the lock was acquired or lost
+        until = timeout is not None and time.time() + timeout
+        while True:
+            remaining = None
+            if timeout is not None:
+                remaining = until - time.time()
+                if remaining <= 0:
+                    break
+            self._changed.wait(remaining)
+            self._changed.clear()
+            if self.is_owner():
+                return True
+            if not self._wanted:
+                return False
+
+        # timed out: leave the queue, unless we got the lock meanwhile
+        self._mutex.acquire()
+        try:
+            if self.is_owner():
+                return True
+            self._wanted = False
+            if self._id:
+                self._remove_node()
+            return False
+        finally:
+            self._mutex.release()
+
+    def _adopt(self, node_id, children):
+        '''Queues for the lock with a lock node created by the caller (see
+        MultiLock) and tries to acquire it.
+        Returns True, if the lock was acquired.
+        :param node_id: Name of the lock node
+        :param children: Listing of the lock nodes including ours
+        '''
+        self._subscribe_session()
+        self._mutex.acquire()
+        try:
+            self._wanted = True
+            self._changed.clear()
+            self._id = node_id
+            self._index = None
+            self._watched_neighbor = None
+            self._index_predecessors(children)
+            return self._try_lock()
+        finally:
+            self._mutex.release()
 
+    def __enter__(self):
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+        return False
+
+    def _lock(self, neighbor = None, deleted = False, holding = False):
+        '''Tries to acquire the lock, unless it was released meanwhile.
+        :param neighbor: The watched node, whose watch fired
+        :param deleted: Whether the watched node was deleted
+        :param holding: Whether the watched node holds the lock exclusively
+        '''
+        self._mutex.acquire()
+        try:
+            if not self._wanted:
+                return False
+            if neighbor:
+                if neighbor != self._watched_neighbor:
+                    # stale watch
+                    return False
+                # the watch is used up
+                self._watched_neighbor = None
+                if deleted:
+                    self._neighbor_deleted(neighbor)
+                elif holding and self._index is not None:
+                    # the nodes in front of the holder are gone
+                    self._index.truncate()
+            return self._try_lock()
+        finally:
+            self._mutex.release()
 
     @zk_retry_operation
-    def _lock(self):
+    def _try_lock(self):
         '''Implementation of the node locking.'''
         max_retry_count = 10;
 
-        former_lock_owner = self._last_owner
+        was_acquired = self._acquired
 
         # while the lock was not acquired or we could not set a watcher
         for _retry_count in range(max_retry_count):
@@ -150,66 +383,58 @@ class Lock(object):
                 session_id, _data = self._connection.client_id()
                 node_name_prefix = self._id_to_node_prefix(session_id)
                 try:
-                    self._id = self._get_or_create_lock_node(node_name_prefix)
+                    self._id = self._create_lock_node(node_name_prefix)
                 except zookeeper.NoNodeException:
                     #TODO: move to connection wrapper
                     raise NoNodeException()
+                self._index = None
+                self._watched_neighbor = None
+                self._waited = False
 
-            # get children and store them as a list of (seq_id, name)
-            children = [ (int(child[child.rfind('-')+1:]), child)
-                          for child in self._connection.get_children(self._path)]
-            if not children:
-                # this case should not happen, as we just added ourself
-                logger.warn('No children in %s but there should be!' % self._path)
-                self._id = None
-                continue
-
-            # sort them by the sequence id. nodeformat: <path>/lock-<session-id>-<sequence number>
-            children.sort(key=operator.itemgetter(0), reverse=False)
-            self._last_owner = children[0][1]
-
-            # search next smaller neighbor
-            me_not_found = True
-            smaller_neighbor = None
-            for _seq_id, name in children:
-                # found our position -> stop
-                if name == self._id:
-                    me_not_found = False
-                    break
-                smaller_neighbor = name
-            if me_not_found:
+            # a listing tells the nodes in front of us. Deleted ones are
+            # dropped from the index, we only check the nearest of them
+            if self._index is None and not self._index_predecessors():
                 logger.warn('Could not find own lock node \'%s\'. Recreating...' % self._id)
                 self._id = None
+                self._set_acquired(False)
                 continue
 
-            # if there is a smaller neighbor: we watch him
-            if smaller_neighbor:
+            # watch the nearest node in front of us, which still exists
+            smaller_neighbor = self._index.nearest()
+            while smaller_neighbor:
                 # only set a watch, if the smaller id has changed
-                if smaller_neighbor != self._watched_neighbor:
-                    logger.debug('watching less than me node: %s' % smaller_neighbor)
-                    stat = self._connection.exists(
-                                        '%s/%s' % (self._path, smaller_neighbor),
-                                         self.__smaller_neighbor_watcher)
-
-                    # we could not get the stat: smaller neighbor does not exist
-                    # anymore
-                    if not stat:
-                        logger.debug('can not watch lesser node %s. Retrying...' % smaller_neighbor)
-                        continue
-
+                if smaller_neighbor == self._watched_neighbor:
+                    return False
+                logger.debug('watching less than me node: %s' % smaller_neighbor)
+                stat = self._connection.exists(
+                                    '%s/%s' % (self._path, smaller_neighbor),
+                                     self.__smaller_neighbor_watcher)
+                if stat:
                     self._watched_neighbor = smaller_neighbor
-
-                # return, that we did not acquire the lock
-                return False
+                    self._waited = True
+                    if stat['version']:
+                        # it holds the lock already
+                        self._index.truncate()
+                    # return, that we did not acquire the lock
+                    return False
+
+                # smaller neighbor does not exist anymore: try the next one
+                logger.debug('can not watch lesser node %s. Trying the next one...' % smaller_neighbor)
+                self._index.discard(smaller_neighbor)
+                smaller_neighbor = self._index.nearest()
 
             # there is no smaller neighbor
-            else:
-                if self.is_owner():
-                    if self.watcher and former_lock_owner != self._id:
-                        self.watcher.lock_acquired()
-                    return True
-                logger.debug('we should be owner, but we arent!')
-                continue
+            self._set_acquired(True)
+            if self.is_owner():
+                if self._exclusive and self._waited:
+                    # tell our successor. A failure only costs it a listing
+                    self._waited = False
+                    self._connection.set_async('%s/%s' % (self._path, self._id), '')
+                if self.watcher and not was_acquired:
+                    self.watcher.lock_acquired()
+                return True
+            logger.debug('we should be owner, but we arent!')
+            self._index = None
 
         raise RuntimeError('Could neither acquire the lock, nor set a watch')
 
@@ -217,25 +442,38 @@ class Lock(object):
         '''Returns true, if this instance holds the lock'''
         return (self._connection.is_somehow_connected()
                 and self._id
-                and self._last_owner
-                and self._id == self._last_owner)
+                and self._acquired)
 
     def release(self):
         '''Releases the lock'''
 
-        if not self._id:
-            logger.warn('Can not release a not acquired lock')
-            return
-        if not self._connection.is_connected():
-            logger.info('No connection. Lock is already released')
-            return
+        self._mutex.acquire()
+        try:
+            self._wanted = False
+            if not self._id:
+                logger.warn('Can not release a not acquired lock')
+                return
+            if not self._connection.is_connected():
+                logger.info('No connection. Lock is already released')
+                return
+
+            try:
+                self._remove_node()
+            finally:
+                if self.watcher:
+                    self.watcher.lock_released()
+        finally:
+            self._mutex.release()
 
+    def _remove_node(self):
+        '''Deletes our lock node'''
         # remove watcher
-        self._connection.remove_global_watcher(self._connection_watcher)
+        self._unsubscribe_session()
 
         # set us to released
         node_id = self._id
         self._id = None
+        self._set_acquired(False)
 
         # we don't need to retry this operation in the case of failure
         # as ZK will remove ephemeral files and we don't want to hang
@@ -245,10 +483,331 @@ class Lock(object):
         # we do not bother, if there is no such node
         except zookeeper.NoNodeException:
             logger.warn('No such node to delete')
-            return
+
+
+class MultiLock(object):
+    '''Holds the locks of several paths at once.
+    The lock nodes of all paths are created and listed concurrently, so free
+    locks are acquired within a single round trip. To avoid deadlocks, the
+    locks are taken in the order of their paths: we only ever wait for one
+    lock, holding the ones in front of it and withdrawing from the ones
+    behind it meanwhile.
+    '''
+
+    def __init__(self, connection, paths):
+        '''Multi lock construction.
+        :param connection: The zkpy connection
+        :param paths: Parent nodes of the locks. Need to exist.
+        '''
+        self._connection = connection
+        self._locks = [Lock(connection, path) for path in sorted(set(paths))]
+
+    @property
+    def paths(self):
+        return [lock.path for lock in self._locks]
+
+    def is_owner(self):
+        '''Returns true, if this instance holds all locks'''
+        for lock in self._locks:
+            if not lock.is_owner():
+                return False
+        return True
+
+    def acquire(self, blocking = False, timeout = None):
+        '''Acquires all locks. If they can not be acquired, none is held.
+        Like all locks of this module, acquire() does not block by default,
+        unless a timeout is given.
+        :param blocking: Waits until the locks are acquired
+        :param timeout: Maximal time to wait in seconds, None waits forever
+        '''
+        blocking = blocking or timeout is not None
+        until = timeout is not None and time.time() + timeout
+        try:
+            while True:
+                pending = [lock for lock in self._locks if not lock.is_owner()]
+                if not pending:
+                    return True
+                waiting = self._queue(pending)
+                if waiting is None:
+                    continue
+
+                # wait for the first lock we did not get
+                remaining = 0
+                if blocking:
+                    remaining = None
+                    if timeout is not None:
+                        remaining = max(until - time.time(), 0)
+                if not waiting.acquire(True, remaining):
+                    self.release()
+                    return False
+        except:
+            self.release()
+            raise
+
+    def _queue(self, pending):
+        '''Creates and lists the lock nodes of the given locks concurrently
+        and acquires them in order. Returns the first lock, which was not
+        acquired, or None.
+        '''
+        session_id, _data = self._connection.client_id()
+        queued = []
+        for lock in pending:
+            node = self._connection.create_async(
+                    join_path(lock.path, lock._id_to_node_prefix(session_id)),
+                    '', lock._acls, NodeCreationMode.EphemeralSequential)
+            # the requests of a session are processed in order, thus the
+            # listing contains the new node
+            children = self._connection.get_children_async(lock.path)
+            queued.append((lock, node, children))
+
+        for index, (lock, node, children) in enumerate(queued):
+            try:
+                acquired = lock._adopt(node.result()[len(lock.path) + 1:],
+                                       children.result())
+            except:
+                self._withdraw(queued[index + 1:])
+                raise
+            if not acquired:
+                # do not block others on the locks behind this one
+                self._withdraw(queued[index + 1:])
+                return lock
+        return None
+
+    def _withdraw(self, queued):
+        '''Deletes the lock nodes of not adopted locks'''
+        deletes = []
+        for _lock, node, _children in queued:
+            if node.exception() is None:
+                deletes.append(self._connection.delete_async(node.result()))
+        wait(deletes)
+
+    def release(self):
+        '''Releases all held locks'''
+        for lock in reversed(self._locks):
+            if lock.id:
+                lock.release()
+
+    def __enter__(self):
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+        return False
+
+
+class ReadLock(Lock):
+    '''Shared part of a ReadWriteLock.
+    Any number of readers hold the lock at the same time. A reader waits only
+    for the nearest writer node in front of it.
+    '''
+
+    _exclusive = False
+
+    def _id_to_node_prefix(self, id):
+        return 'read-%s-' % str(id)
+
+    def _blocking_nodes(self, predecessors):
+        return [(seq, name) for seq, name in predecessors
+                if name.startswith('write-')]
+
+
+class WriteLock(Lock):
+    '''Exclusive part of a ReadWriteLock.
+    A writer waits for its immediate predecessor, regardless of whether it is a
+    reader or a writer.
+    '''
+
+    def _id_to_node_prefix(self, id):
+        return 'write-%s-' % str(id)
+
+
+class ReadWriteLock(object):
+    '''Distributed read/write lock.
+    Readers and writers queue up under the same node. Readers share the lock
+    with all readers in front of them up to the next writer, writers hold it
+    exclusively. As with Lock, there is one read and one write lock node per
+    connection.
+    '''
+
+    def __init__(self, connection, path, read_watcher = None, write_watcher = None):
+        '''Read/write lock construction.
+        :param connection: The zkpy connection
+        :param path: Parent node under which the lock nodes are created.
+                     Needs to exist.
+        :param read_watcher: Lock watcher object of the read lock
+        :param write_watcher: Lock watcher object of the write lock
+        '''
+        self.read_lock = ReadLock(connection, path, read_watcher)
+        self.write_lock = WriteLock(connection, path, write_watcher)
+
+    @property
+    def path(self):
+        return self.read_lock.path
+
+
+class _ManagedLockEntry(object):
+    '''Local state of a lock served by a LockManager'''
+
+    def __init__(self, mutex):
+        self.lock = None
+        # local threads holding or waiting for the lock
+        self.users = 0
+        self.held = False
+        self.condition = threading.Condition(mutex)
+
+
+class NamedLock(object):
+    '''Handle of a lock served by a LockManager. Behaves like
+    threading.Lock and may be used in a with statement.
+    '''
+
+    def __init__(self, manager, path):
+        self._manager = manager
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def acquire(self, blocking = False, timeout = None):
+        '''Acquires the lock. Returns False, if it could not be acquired
+        without blocking or within the timeout. Unlike Lock, a non-blocking
+        call does not stay queued.
+        Like all locks of this module, acquire() does not block by default,
+        unless a timeout is given.
+        :param blocking: Waits until the lock is acquired
+        :param timeout: Maximal time to wait in seconds, None waits forever
+        '''
+        blocking = blocking or timeout is not None
+        return self._manager._acquire(self._path, blocking, timeout)
+
+    def release(self):
+        '''Releases the lock'''
+        self._manager._release(self._path)
+
+    def __enter__(self):
+        self.acquire(blocking=True)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+        return False
+
+
+class LockManager(object):
+    '''Serves any number of named locks over a single connection.
+    As lock nodes are keyed by the session, there can only be one Lock per
+    path and connection. The manager keeps this Lock and queues the local
+    threads asking for it, so that a process needs at most one lock node per
+    path. When a lock is released while local threads wait for it, it is
+    handed over to the next of them without a Zookeeper round trip. Note,
+    that this favours local threads over other processes.
+    '''
+
+    def __init__(self, connection, acls = None):
+        '''Lock manager construction.
+        :param connection: The zkpy connection
+        :param acls: Access control list used to create missing lock paths.
+                     If None, the lock paths need to exist.
+        '''
+        self._connection = connection
+        self._acls = acls
+        # path -> _ManagedLockEntry of the locks held or waited for
+        self._entries = {}
+        self._mutex = threading.Lock()
+
+    def lock(self, path):
+        '''Returns the lock of the given path.
+        :param path: Parent node of the lock nodes
+        '''
+        return NamedLock(self, path)
+
+    def __len__(self):
+        '''Number of locks held or waited for'''
+        return len(self._entries)
+
+    def _acquire(self, path, blocking, timeout):
+        until = timeout is not None and time.time() + timeout
+
+        self._mutex.acquire()
+        try:
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = self._entries[path] = _ManagedLockEntry(self._mutex)
+            entry.users += 1
+
+            # wait for the local holder
+            while entry.held:
+                remaining = None
+                if timeout is not None:
+                    remaining = until - time.time()
+                if not blocking or (remaining is not None and remaining <= 0):
+                    self._leave(path, entry)
+                    return False
+                entry.condition.wait(remaining)
+            entry.held = True
+            lock = entry.lock
         finally:
-            if self.watcher:
-                self.watcher.lock_released()
+            self._mutex.release()
+
+        # we are the only local thread for this path: get the lock node
+        acquired = False
+        try:
+            if lock is None:
+                if self._acls is not None:
+                    self._connection.ensure_path_exists(path, '', self._acls, True)
+                lock = entry.lock = Lock(self._connection, path)
+            if not blocking:
+                timeout = 0
+            elif timeout is not None:
+                timeout = max(until - time.time(), 0)
+            acquired = lock.acquire(True, timeout)
+            return acquired
+        finally:
+            if not acquired:
+                self._mutex.acquire()
+                try:
+                    entry.held = False
+                    self._leave(path, entry)
+                finally:
+                    self._mutex.release()
+
+    def _leave(self, path, entry):
+        '''Removes a local user from the entry. Requires the mutex.'''
+        entry.users -= 1
+        if entry.users:
+            if not entry.held:
+                entry.condition.notify()
+        elif self._entries.get(path) is entry:
+            del self._entries[path]
+
+    def _release(self, path):
+        self._mutex.acquire()
+        try:
+            entry = self._entries.get(path)
+            if entry is None or not entry.held:
+                raise RuntimeError('Lock %s is not held' % path)
+            if entry.users > 1:
+                # hand over to the next local thread, keeping the lock node
+                entry.held = False
+                self._leave(path, entry)
+                return
+            lock = entry.lock
+        finally:
+            self._mutex.release()
+
+        # nobody waits: release the lock node. The entry stays held meanwhile,
+        # so that no second Lock object is created for this path.
+        try:
+            lock.release()
+        finally:
+            self._mutex.acquire()
+            try:
+                entry.held = False
+                self._leave(path, entry)
+            finally:
+                self._mutex.release()
 
 
 def main():
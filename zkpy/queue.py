@@ -4,10 +4,15 @@ Created on 07.09.2010
 @author: luk
 '''
 
+from collections import deque
 from zkpy import zk_retry_operation
-from zkpy.connection import NodeCreationMode
+from zkpy.connection import NodeCreationMode, EventType, KeeperState
+from zkpy.future import pipeline
+import bisect
 import logging
+import random
 import threading
+import time
 import zookeeper
 
 class Queue(object):
@@ -15,10 +20,14 @@ class Queue(object):
 
     logger = logging.getLogger('Queue')
 
-    def __init__(self, connection, path):
+    def __init__(self, connection, path, cache_length = False):
         '''Sets up the queue.
         :param connection: The zkpy connection to use
         :param path: The parent path of the Queue. Needs to exist!
+        :param cache_length: If True, len() is served from a cached item
+                             count, which is invalidated by a child watch.
+                             This avoids any request while the queue does not
+                             change, but costs a listing after each change.
 
         Note: Queue nodes will have the same acl as the provided queue node.
 
@@ -26,6 +35,23 @@ class Queue(object):
         self.zk_conn = connection
         self.path = path
 
+        # consumers blocked in pop_blocking()
+        self._waiters = deque()
+        self._waiters_lock = threading.Lock()
+        self._watch_armed = False
+        # ready items of the last listing of the child watch. Waiters are
+        # woken up for the items, which were not listed before.
+        self._listed = set()
+        # time the next not yet ready item gets ready
+        self._next_ready = None
+
+        # length cache and metrics
+        self._cache_length = cache_length
+        self._cached_length = None
+        self._length_generation = 0
+        self._counters = {'pushed' : 0, 'popped' : 0, 'pop_conflicts' : 0, 'listings' : 0}
+        self._counters_lock = threading.Lock()
+
         try:
             _stat, self.node_acl = self.zk_conn.get_acl(path)
         except zookeeper.NoNodeException:
@@ -33,18 +59,60 @@ class Queue(object):
 
 
 
+    def _item_prefix(self):
+        '''Returns the node name prefix of an item'''
+        return 'item-'
+
+    def _ready_items(self, items):
+        '''Filters the sorted item names. Returns a tuple of the names of the
+        items, which can be popped now, and the time when the next one gets
+        ready (None: no such item).
+        '''
+        return items, None
+
     @zk_retry_operation
+    def _create_item(self, prefix, data):
+        self.zk_conn.create('%s/%s' % (self.path, prefix),
+                            data,
+                            self.node_acl,
+                            NodeCreationMode.PersistentSequential)
+        self._count('pushed')
+        return True
+
+    def _create_items(self, entries, window):
+        '''Creates the items of the (prefix, data) entries in parallel'''
+        def create(entry):
+            prefix, data = entry
+            return self.zk_conn.create_async('%s/%s' % (self.path, prefix),
+                                             data,
+                                             self.node_acl,
+                                             NodeCreationMode.PersistentSequential)
+        futures = [future for _entry, future in pipeline(create, entries, window)]
+        self._count('pushed', len([future for future in futures if future.exception() is None]))
+        return futures
+
     def push(self, data):
         '''Push an item to the end of the queue.
 
         :return: True, if queue could be added.
 
         '''
-        self.zk_conn.create('%s/item-' % self.path,
-                            data,
-                            self.node_acl,
-                            NodeCreationMode.PersistentSequential)
-        return True
+        return self._create_item(self._item_prefix(), data)
+
+    def push_many(self, items, window = 1000):
+        '''Pushes several items to the end of the queue. The item nodes are
+        created in parallel (at most window requests in flight). As zookeeper
+        processes a session's requests in order, the items keep their order
+        in the queue.
+
+        Note: failed pushes are not retried, since a sequential node might
+        have been created despite a connection loss.
+
+        :return: a list with a completed future per item. Its result is the
+                 path of the item node, or it holds the exception.
+        '''
+        prefix = self._item_prefix()
+        return self._create_items(((prefix, data) for data in items), window)
 
     @zk_retry_operation
     def pop(self):
@@ -54,16 +122,20 @@ class Queue(object):
         # get queue items
         items = self.zk_conn.get_children(self.path)
         items.sort()
+        self._count('listings')
+        items, self._next_ready = self._ready_items(items)
 
         # try all items
         for item in items:
             try:
                 item_path = '%s/%s' % (self.path, item)
                 # try to get this item and delete it
-                return self._remove(item_path)
+                data = self._remove(item_path)
+                self._count('popped')
+                return data
             except zookeeper.NoNodeException:
                 # another consumer already popped this item. let's just move on
-                pass
+                self._count('pop_conflicts')
 
         # all items were consumed by another consumer...
         raise IndexError('pop from empty list')
@@ -84,42 +156,643 @@ class Queue(object):
                 continue
 
 
+    def _take(self, item, read):
+        '''Removes an item read by a get_async() future. The node is deleted
+        with the version read, thus the data is the one removed. Returns
+        [(item, data)], or [] if another consumer removed the item.
+        '''
+        item_path = '%s/%s' % (self.path, item)
+        exception = read.exception()
+        if isinstance(exception, zookeeper.NoNodeException):
+            self._count('pop_conflicts')
+            return []
+        elif isinstance(exception, zookeeper.ConnectionLossException):
+            # fall back to the retrying removal
+            removed = self._remove_single(item, item_path)
+        elif exception is not None:
+            raise exception
+        else:
+            data, stat = read.result()
+            try:
+                try:
+                    self.zk_conn.delete(item_path, stat['version'])
+                except zookeeper.ConnectionLossException:
+                    # the delete may have been applied before the connection
+                    # was lost: a missing node is ours then
+                    try:
+                        zk_retry_operation(self.zk_conn.delete)(item_path, stat['version'])
+                    except zookeeper.NoNodeException:
+                        pass
+            except zookeeper.NoNodeException:
+                self._count('pop_conflicts')
+                return []
+            except zookeeper.BadVersionException:
+                self.logger.warn('Queue item "%s" was modified. This should not be done.' % item_path)
+                removed = self._remove_single(item, item_path)
+            else:
+                removed = [(item, data)]
+        self._count('popped', len(removed))
+        return removed
+
+    def _remove_single(self, item, item_path):
+        '''Removes an item with _remove(). Returns [(item, data)], or [] if
+        another consumer removed it.
+        '''
+        try:
+            return [(item, self._remove(item_path))]
+        except zookeeper.NoNodeException:
+            self._count('pop_conflicts')
+            return []
+
+    @zk_retry_operation
+    def _list_items(self, watcher = None):
+        '''Returns the sorted names of the items, which are ready'''
+        items = self.zk_conn.get_children(self.path, watcher)
+        items.sort()
+        self._count('listings')
+        items, self._next_ready = self._ready_items(items)
+        return items
+
+    def _until_ready(self, until):
+        '''Returns the seconds to wait for a new item: until the given time or
+        the time the next item gets ready (None: infinitely)
+        '''
+        next_ready = self._next_ready
+        if next_ready is not None and (until is None or next_ready < until):
+            until = next_ready
+        if until is None:
+            return None
+        return max(0, until - time.time())
+
+    def consume(self, prefetch = 1, block = False, timeout = None):
+        '''Iterates over the items popped from the head of the queue.
+
+        Other than pop(), the item names are listed only when the locally
+        cached view is exhausted. The next prefetch items are read in
+        parallel, but each item is removed only when it is yielded. Thus
+        stopping the iteration early leaves the not yet yielded items at the
+        head of the queue, at the cost of a round trip per removal.
+
+        :param prefetch: number of items to read per round trip
+        :param block: if True, waits for new items (using a child watch) when
+                      the queue is empty. Otherwise the iteration stops.
+        :param timeout: stop waiting for new items after timeout seconds
+        '''
+        names = deque()
+        changed = threading.Event()
+        def watcher(handle, event, type, path):
+            changed.set()
+
+        # (item, get_async() future) of the items read, but not removed yet
+        reads = deque()
+        while True:
+            while reads:
+                item, read = reads.popleft()
+                for _item, data in self._take(item, read):
+                    yield data
+
+            if not names:
+                names.extend(self._list_items())
+            if not names:
+                if not block:
+                    return
+                # list again with a watch to not miss an item
+                changed.clear()
+                names.extend(self._list_items(watcher))
+                if not names:
+                    until = None
+                    if timeout is not None:
+                        until = time.time() + timeout
+                    changed.wait(self._until_ready(until))
+                    if changed.isSet():
+                        continue
+                    if self._next_ready is not None and time.time() >= self._next_ready:
+                        # an item got ready
+                        continue
+                    return
+
+            for _ in range(min(prefetch, len(names))):
+                item = names.popleft()
+                reads.append((item, self.zk_conn.get_async('%s/%s' % (self.path, item))))
+
+    def _watch_children(self):
+        '''Lists the items with a child watch, if no watch is set yet, and
+        wakes up waiting consumers for the listed items.
+        '''
+        self._waiters_lock.acquire()
+        try:
+            if self._watch_armed:
+                return
+            self._watch_armed = True
+        finally:
+            self._waiters_lock.release()
+
+        future = self.zk_conn.get_children_async(self.path, self._children_watcher)
+        future.add_done_callback(self._children_listed)
+
+    def _children_watcher(self, handle, type, state, path):
+        '''Child watch shared by all blocked consumers of this object'''
+        if type == EventType.NoneType:
+            # session event: the watch stays registered unless expired
+            if state == KeeperState.Expired:
+                self._waiters_lock.acquire()
+                try:
+                    self._watch_armed = False
+                    self._listed = set()
+                finally:
+                    self._waiters_lock.release()
+                self._wake_waiters()
+            return
+
+        self._waiters_lock.acquire()
+        try:
+            self._watch_armed = False
+            if not self._waiters:
+                # nobody waits: the next blocked consumer sets a new watch
+                return
+        finally:
+            self._waiters_lock.release()
+        self._watch_children()
+
+    def _children_listed(self, future):
+        if future.exception() is not None:
+            self._waiters_lock.acquire()
+            try:
+                self._watch_armed = False
+                self._listed = set()
+            finally:
+                self._waiters_lock.release()
+            # let the consumers retry (and see the error)
+            self._wake_waiters()
+        else:
+            ready, next_ready = self._ready_items(sorted(future.result()))
+            ready = set(ready)
+            # items listed before have woken up a consumer already
+            self._waiters_lock.acquire()
+            try:
+                new_items = len(ready - self._listed)
+                self._listed = ready
+                self._next_ready = next_ready
+                if next_ready is not None:
+                    # consumers, which would sleep past the next due time,
+                    # compute their wait again
+                    waiting = deque()
+                    for waiter in self._waiters:
+                        if waiter.deadline is None or waiter.deadline > next_ready:
+                            waiter.set()
+                        else:
+                            waiting.append(waiter)
+                    self._waiters = waiting
+            finally:
+                self._waiters_lock.release()
+            self._wake_waiters(new_items)
+
+    def _wake_waiters(self, count = None):
+        '''Wakes up count waiting consumers (all, if count is None)'''
+        self._waiters_lock.acquire()
+        try:
+            if count is None:
+                count = len(self._waiters)
+            for _ in range(min(count, len(self._waiters))):
+                self._waiters.popleft().set()
+        finally:
+            self._waiters_lock.release()
+
     def pop_blocking(self, timeout=None):
         '''Pops from the head of the queue. Blocks until there is at least
         one element.
 
+        Blocked consumers of this object share a single child watch. When it
+        fires, only as many consumers are woken up as there are new items,
+        and those waiting past the due time of a new delayed item.
         '''
-
-        # set up a queue watcher.
-        condition = threading.Event()
-        def watcher(handle, event, type, path):
-            condition.set()
-
-        # set watcher
-        self.zk_conn.exists(self.path, watcher)
+        until = None
+        if timeout is not None:
+            until = time.time() + timeout
 
         while True:
+            # register before popping, thus no item can be missed. The
+            # deadline of the wait is not known yet.
+            waiter = threading.Event()
+            waiter.deadline = None
+            self._waiters_lock.acquire()
             try:
-                return self.pop()
-            except IndexError:
-                # queue was empty. wait that something changes...
-                condition.wait(timeout)
+                self._waiters.append(waiter)
+            finally:
+                self._waiters_lock.release()
+
+            try:
+                self._watch_children()
+                try:
+                    return self.pop()
+                except IndexError:
+                    pass
+
+                # queue was empty. wait that something is pushed (or the
+                # next item gets ready)...
+                self._waiters_lock.acquire()
+                try:
+                    remaining = self._until_ready(until)
+                    if remaining is not None:
+                        waiter.deadline = time.time() + remaining
+                finally:
+                    self._waiters_lock.release()
+                waiter.wait(remaining)
                 # check for timeout
-                if not condition.isSet():
+                if not waiter.isSet() and until is not None and time.time() >= until:
                     raise RuntimeError('pop_blocking timed out')
-                # reset condition. in case a node was added and removed..
-                condition.clear()
+            finally:
+                self._waiters_lock.acquire()
+                try:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                finally:
+                    self._waiters_lock.release()
+
+    def _count(self, name, increment = 1):
+        self._counters_lock.acquire()
+        try:
+            self._counters[name] += increment
+        finally:
+            self._counters_lock.release()
 
+    @zk_retry_operation
+    def _stat_length(self):
+        '''Returns the number of children of the queue node'''
+        stat = self.zk_conn.exists(self.path)
+        if stat is None:
+            raise RuntimeError('Path %s does not exists.' % self.path)
+        return stat['numChildren']
+
+    def _length_watcher(self, handle, type, state, path):
+        # invalidate on any event. session events included, as changes might
+        # get lost while disconnected
+        self._length_generation += 1
+        self._cached_length = None
+
+    @zk_retry_operation
+    def _watch_length(self):
+        '''Counts the items and sets a child watch to invalidate the count'''
+        generation = self._length_generation
+        length = len(self.zk_conn.get_children(self.path, self._length_watcher))
+        self._count('listings')
+        # do not cache, if the watch fired in the meantime
+        if generation == self._length_generation:
+            self._cached_length = length
+        return length
 
     def __len__(self):
-        '''Returns the number of items in the queue.'''
-        return len(self.items())
+        '''Returns the number of items in the queue. It is read from the queue
+        node's stat (or the cache), thus the items are not listed.
+        '''
+        if not self._cache_length:
+            return self._stat_length()
+        length = self._cached_length
+        if length is None:
+            length = self._watch_length()
+        return length
 
     def is_empty(self):
         '''Returns True, if no items are in the queue'''
         return len(self) == 0
 
+    def metrics(self):
+        '''Returns a dict with the queue length and the counters of this
+        object: pushed and popped items, pop_conflicts (items taken by another
+        consumer first) and listings of the items.
+        '''
+        self._counters_lock.acquire()
+        try:
+            metrics = dict(self._counters)
+        finally:
+            self._counters_lock.release()
+        metrics['length'] = len(self)
+        return metrics
+
+
+class PriorityQueue(Queue):
+    '''Distributed priority queue. Items with a lower priority value are
+    popped first, items of the same priority in FIFO order.
+
+    The priority is part of the item node name (item-<priority>-<sequence>),
+    thus a sorted listing yields the next item.
+    '''
+
+    max_priority = 999
+
+    def __init__(self, connection, path, default_priority = 500, cache_length = False):
+        '''Sets up the queue (see Queue).
+        :param default_priority: priority of items pushed without a priority
+                                 (0 ... max_priority)
+        '''
+        Queue.__init__(self, connection, path, cache_length)
+        self.default_priority = default_priority
+
+    def _priority_prefix(self, priority):
+        if priority is None:
+            priority = self.default_priority
+        if not 0 <= priority <= self.max_priority:
+            raise ValueError('Priority %s is not in [0, %d]' % (priority, self.max_priority))
+        return 'item-%03d-' % priority
+
+    def _item_prefix(self):
+        return self._priority_prefix(None)
 
+    def push(self, data, priority = None):
+        '''Push an item with the given priority (default: default_priority).
 
+        :return: True, if queue could be added.
+        '''
+        return self._create_item(self._priority_prefix(priority), data)
+
+    def push_many(self, items, priority = None, window = 1000):
+        '''Pushes several items with the same priority (see Queue.push_many)'''
+        prefix = self._priority_prefix(priority)
+        return self._create_items(((prefix, data) for data in items), window)
+
+
+class DelayedQueue(Queue):
+    '''Distributed queue, whose items can be popped after their due time.
+    Items are popped in the order of their due time.
+
+    The due time (milliseconds since the epoch) is part of the item node name
+    (item-<due>-<sequence>), thus the ready items are a prefix of the sorted
+    listing. Blocked consumers wake up locally at the next due time instead
+    of polling.
+
+    Note: the clocks of the producers and consumers need to be synchronized.
+    '''
+
+    def _due_prefix(self, due):
+        return 'item-%013d-' % int(due * 1000)
+
+    def _item_prefix(self):
+        return self._due_prefix(time.time())
+
+    def _ready_items(self, items):
+        # '.' sorts after '-', thus all items due until now are before it
+        index = bisect.bisect_left(items, 'item-%013d.' % int(time.time() * 1000))
+        next_ready = None
+        if index < len(items):
+            next_ready = int(items[index][5:18]) / 1000.
+        return items[:index], next_ready
+
+    def push(self, data, delay = 0, due = None):
+        '''Push an item, which gets ready after delay seconds (or at the
+        due time, seconds since the epoch).
+
+        :return: True, if queue could be added.
+        '''
+        if due is None:
+            due = time.time() + delay
+        return self._create_item(self._due_prefix(due), data)
+
+    def push_many(self, items, delay = 0, due = None, window = 1000):
+        '''Pushes several items with the same due time (see Queue.push_many)'''
+        if due is None:
+            due = time.time() + delay
+        prefix = self._due_prefix(due)
+        return self._create_items(((prefix, data) for data in items), window)
+
+
+class ShardedQueue(object):
+    '''Distributed queue, which spreads its items over several shard queues
+    to reduce the contention between consumers.
+
+    Items are pushed to the shards round robin. A consumer pops from its home
+    shard and, if it is empty, rotates to the next shard with items (which
+    becomes its new home). Thus consumers mostly work on different shards.
+    The order of the items is approximately FIFO.
+    '''
+
+    logger = logging.getLogger('ShardedQueue')
+
+    def __init__(self, connection, path, shards, home = None):
+        '''Sets up the queue.
+        :param connection: The zkpy connection to use
+        :param path: The parent path of the queue. Needs to exist! The shard
+                     nodes are created below it, if needed.
+        :param shards: number of shards. All producers and consumers of a
+                       queue need to use the same number.
+        :param home: index of the consumer's home shard (default: random)
+        '''
+        self.zk_conn = connection
+        self.path = path
+
+        try:
+            _stat, self.node_acl = self.zk_conn.get_acl(path)
+        except zookeeper.NoNodeException:
+            raise RuntimeError('Path %s does not exists.' % self.path)
+
+        shard_paths = ['%s/shard-%04d' % (path, index) for index in range(shards)]
+        self.zk_conn.ensure_tree(shard_paths, '', self.node_acl)
+        self.shards = [Queue(connection, shard_path) for shard_path in shard_paths]
+
+        if home is None:
+            home = random.randrange(shards)
+        self._home = home % shards
+        self._next_push = random.randrange(shards)
+
+        # consumers blocked in pop_blocking() share a child watch per shard
+        self._waiters = deque()
+        self._waiters_lock = threading.Lock()
+        self._watchers = [self._shard_watcher(index) for index in range(shards)]
+        self._armed = [False] * shards
+        # items of the last listing of each shard
+        self._listed = [set() for _ in range(shards)]
+
+    def _next_shard(self):
+        '''Returns the next shard to push to'''
+        index = self._next_push
+        self._next_push = (index + 1) % len(self.shards)
+        return self.shards[index]
+
+    def _rotation(self):
+        '''Returns the shard indices, starting at the home shard'''
+        count = len(self.shards)
+        return [(self._home + offset) % count for offset in range(count)]
+
+    def push(self, data):
+        '''Push an item to the end of the next shard.
 
+        :return: True, if queue could be added.
+        '''
+        return self._next_shard().push(data)
 
+    def push_many(self, items, window = 1000):
+        '''Pushes several items, spread round robin over the shards.
+        :return: a list with a completed future per item (see Queue.push_many)
+        '''
+        batches = {}
+        for position, data in enumerate(items):
+            shard = self._next_shard()
+            batches.setdefault(shard, []).append((position, data))
+
+        futures = {}
+        for shard, batch in batches.iteritems():
+            shard_futures = shard.push_many([data for _position, data in batch], window)
+            for (position, _data), future in zip(batch, shard_futures):
+                futures[position] = future
+        return [futures[position] for position in sorted(futures)]
+
+    def pop(self):
+        '''Pops one item, preferably from the home shard.
+        Raises an IndexError if there is no item in the queue
+        '''
+        for index in self._rotation():
+            try:
+                data = self.shards[index].pop()
+            except IndexError:
+                continue
+            # stick with a shard which has items
+            self._home = index
+            return data
+        raise IndexError('pop from empty list')
+
+    def consume(self, prefetch = 1):
+        '''Iterates over popped items (see Queue.consume). Drains the home
+        shard first and rotates over the other shards, until all are empty.
+        '''
+        while True:
+            consumed = False
+            for index in self._rotation():
+                for data in self.shards[index].consume(prefetch):
+                    self._home = index
+                    consumed = True
+                    yield data
+            if not consumed:
+                return
+
+    def _watch_shard(self, index):
+        '''Lists a shard with a child watch, if no watch is set yet'''
+        self._waiters_lock.acquire()
+        try:
+            if self._armed[index]:
+                return
+            self._armed[index] = True
+        finally:
+            self._waiters_lock.release()
+
+        future = self.zk_conn.get_children_async(self.shards[index].path,
+                                                 self._watchers[index])
+        future.add_done_callback(lambda future: self._shard_listed(index, future))
+
+    def _shard_watcher(self, index):
+        '''Returns the child watcher of a shard'''
+        def watcher(handle, type, state, path):
+            if type == EventType.NoneType:
+                # session event: the watch stays registered unless expired
+                if state == KeeperState.Expired:
+                    self._waiters_lock.acquire()
+                    try:
+                        self._armed[index] = False
+                        self._listed[index] = set()
+                    finally:
+                        self._waiters_lock.release()
+                    self._wake_waiters()
+                return
+
+            self._waiters_lock.acquire()
+            try:
+                self._armed[index] = False
+                if not self._waiters:
+                    # nobody waits: the next blocked consumer sets a new watch
+                    return
+            finally:
+                self._waiters_lock.release()
+            self._watch_shard(index)
+        return watcher
+
+    def _shard_listed(self, index, future):
+        exception = future.exception()
+        if exception is not None:
+            self._waiters_lock.acquire()
+            try:
+                self._armed[index] = False
+                self._listed[index] = set()
+            finally:
+                self._waiters_lock.release()
+            self.logger.warn('Could not watch %s: %s' % (self.shards[index].path, exception))
+            # let the consumers retry (and see the error)
+            self._wake_waiters()
+        else:
+            items = set(future.result())
+            # items listed before have woken up a consumer already
+            self._waiters_lock.acquire()
+            try:
+                new_items = len(items - self._listed[index])
+                self._listed[index] = items
+            finally:
+                self._waiters_lock.release()
+            self._wake_waiters(new_items)
+
+    def _wake_waiters(self, count = None):
+        '''Wakes up count waiting consumers (all, if count is None)'''
+        self._waiters_lock.acquire()
+        try:
+            if count is None:
+                count = len(self._waiters)
+            for _ in range(min(count, len(self._waiters))):
+                self._waiters.popleft().set()
+        finally:
+            self._waiters_lock.release()
+
+    def pop_blocking(self, timeout = None):
+        '''Pops an item. Blocks until there is at least one element in one of
+        the shards.
+
+        Blocked consumers of this object share a child watch per shard. When
+        one fires, only as many consumers are woken up as there are new items
+        in the shard.
+        '''
+        until = None
+        if timeout is not None:
+            until = time.time() + timeout
+
+        while True:
+            # register before popping, thus no item can be missed
+            waiter = threading.Event()
+            self._waiters_lock.acquire()
+            try:
+                self._waiters.append(waiter)
+            finally:
+                self._waiters_lock.release()
+
+            try:
+                for index in range(len(self.shards)):
+                    self._watch_shard(index)
+                try:
+                    return self.pop()
+                except IndexError:
+                    pass
+
+                remaining = None
+                if until is not None:
+                    remaining = max(0, until - time.time())
+                waiter.wait(remaining)
+                if not waiter.isSet():
+                    raise RuntimeError('pop_blocking timed out')
+            finally:
+                self._waiters_lock.acquire()
+                try:
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                finally:
+                    self._waiters_lock.release()
+
+    def __len__(self):
+        '''Returns the number of items in all shards (from the shard nodes'
+        stats, read in parallel).
+        '''
+        futures = [self.zk_conn.exists_async(shard.path) for shard in self.shards]
+        length = 0
+        for future in futures:
+            stat = future.result()
+            if stat is None:
+                raise RuntimeError('Shard of %s does not exist.' % self.path)
+            length += stat['numChildren']
+        return length
+
+    def is_empty(self):
+        '''Returns True, if no items are in the queue'''
+        return len(self) == 0
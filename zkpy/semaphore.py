@@ -0,0 +1,166 @@
+'''
+Created on 16.10.2010
+
+@author: luk
+'''
+
+from zkpy import zk_retry_operation
+from zkpy.connection import EventType
+from zkpy.exceptions import NoNodeException
+from zkpy.lock import Lock, _SequenceIndex, _sequence
+import logging
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+class Semaphore(Lock):
+    '''Distributed semaphore.
+    Up to permits holders proceed at the same time, like Lock there is one
+    lease node per connection. The first waiter watches the holders in front
+    of it, so it notices any of them leaving, but not the arrival of new
+    waiters. All other waiters watch their predecessor only, which wakes
+    them up by setting its data, once it holds a permit itself.
+    '''
+
+    def __init__(self, connection, path, permits, watcher = None):
+        '''Semaphore construction.
+        :param connection: The zkpy connection
+        :param path: Parent node under which the lease nodes are created.
+                     Needs to exist. Note: children will have the same ACL as
+                     this node
+        :param permits: Number of concurrent holders
+        :param watcher: Lock watcher object. Needs to implement a lock_acquired()
+                        and lock_released() method.
+        '''
+        Lock.__init__(self, connection, path, watcher)
+        self.permits = permits
+        # holders watched by the first waiter, None if not the first one
+        self._holders = None
+
+    def _id_to_node_prefix(self, id):
+        return 'lease-%s-' % str(id)
+
+    def _blocking_nodes(self, predecessors):
+        if len(predecessors) < self.permits:
+            return []
+        return predecessors
+
+    def _neighbor_deleted(self, neighbor):
+        # the permits may have moved on: list the lease nodes again
+        self._index = None
+
+    def __holder_watcher(self, handle, type, state, path):
+        # session events are handled by the connection watcher
+        if type == EventType.NoneType:
+            return
+        holder = path[len(self._path)+1:]
+        self._mutex.acquire()
+        try:
+            if not self._wanted or self._holders is None or holder not in self._holders:
+                return
+            if (type != EventType.NodeDeleted and
+                zk_retry_operation(self._connection.exists)(path, self.__holder_watcher)):
+                # it set its data on acquiring: keep watching it
+                return
+            # the other holders are all nodes in front of ours
+            self._holders.discard(holder)
+            self._index = _SequenceIndex([(_sequence(name), name) for name in self._holders])
+            self._holders = None
+            self._try_lock()
+        finally:
+            self._mutex.release()
+
+    def __neighbor_watcher(self, handle, type, state, path):
+        if type == EventType.NoneType:
+            return
+        # the predecessor left or got ahead: check our position again
+        self._lock(path[len(self._path)+1:], True)
+
+    @zk_retry_operation
+    def _try_lock(self):
+        '''Implementation of the semaphore'''
+        max_retry_count = 10;
+
+        was_acquired = self._acquired
+
+        for _retry_count in range(max_retry_count):
+            # create our node if needed or recover from old session
+            if not self._id:
+                session_id, _data = self._connection.client_id()
+                try:
+                    self._id = self._create_lock_node(self._id_to_node_prefix(session_id))
+                except zookeeper.NoNodeException:
+                    raise NoNodeException()
+                self._index = None
+                self._watched_neighbor = None
+                self._holders = None
+                self._waited = False
+
+            if self._index is None and not self._index_predecessors():
+                logger.warn('Could not find own lease node \'%s\'. Recreating...' % self._id)
+                self._id = None
+                self._set_acquired(False)
+                continue
+
+            if len(self._index) == self.permits:
+                # first waiter: watch for any holder to leave
+                if self._holders is not None:
+                    return False
+                holders = self._index.names()
+                for holder in holders:
+                    if not self._connection.exists('%s/%s' % (self._path, holder),
+                                                   self.__holder_watcher):
+                        # it left already: its permit is ours
+                        holders.remove(holder)
+                        self._index = _SequenceIndex([(_sequence(name), name)
+                                                      for name in holders])
+                        break
+                else:
+                    self._holders = set(holders)
+                    self._waited = True
+                    return False
+
+            elif len(self._index) > self.permits:
+                # wait for the predecessor to move on
+                neighbor = self._index.nearest()
+                if neighbor == self._watched_neighbor:
+                    return False
+                stat = self._connection.exists('%s/%s' % (self._path, neighbor),
+                                               self.__neighbor_watcher)
+                if stat and not stat['version']:
+                    self._watched_neighbor = neighbor
+                    self._waited = True
+                    return False
+                # it left or holds a permit already: check our position again
+                self._index = None
+                continue
+
+            # we hold a permit
+            self._holders = None
+            self._watched_neighbor = None
+            self._set_acquired(True)
+            if self._waited:
+                # our successor may have become the first waiter
+                self._waited = False
+                try:
+                    self._connection.set('%s/%s' % (self._path, self._id), '')
+                except zookeeper.NoNodeException:
+                    self._id = None
+                    self._set_acquired(False)
+                    continue
+            if self.is_owner():
+                if self.watcher and not was_acquired:
+                    self.watcher.lock_acquired()
+                return True
+            logger.debug('we should hold a permit, but we dont!')
+            self._index = None
+
+        raise RuntimeError('Could neither acquire a permit, nor set a watch')
+
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,713 @@
+'''
+Created on 14.10.2010
+
+@author: luk
+
+In-process stand-in for zookeeper's C binding. A FakeZookeeper provides the
+call surface of the zookeeper module (handle based calls, asynchronous calls,
+constants and exceptions) on top of an in-memory tree, which allows to run
+and benchmark zkpy without a zookeeper ensemble:
+
+    fake = FakeZookeeper(latency=0.001, jitter=0.0005)
+    conn = Connection('fake', 5, backend=fake)
+
+If the C binding is not installed at all, install() registers a
+FakeZookeeper as the zookeeper module before zkpy.connection is imported.
+'''
+
+from collections import deque
+import logging
+import random
+import sys
+import threading
+import time
+
+try:
+    import zookeeper as _zookeeper
+except ImportError:
+    _zookeeper = None
+
+
+logger = logging.getLogger(__name__)
+
+# return codes
+OK                      = 0
+SYSTEMERROR             = -1
+RUNTIMEINCONSISTENCY    = -2
+DATAINCONSISTENCY       = -3
+CONNECTIONLOSS          = -4
+MARSHALLINGERROR        = -5
+UNIMPLEMENTED           = -6
+OPERATIONTIMEOUT        = -7
+BADARGUMENTS            = -8
+INVALIDSTATE            = -9
+APIERROR                = -100
+NONODE                  = -101
+NOAUTH                  = -102
+BADVERSION              = -103
+NOCHILDRENFOREPHEMERALS = -108
+NODEEXISTS              = -110
+NOTEMPTY                = -111
+SESSIONEXPIRED          = -112
+INVALIDCALLBACK         = -113
+INVALIDACL              = -114
+AUTHFAILED              = -115
+CLOSING                 = -116
+NOTHING                 = -117
+SESSIONMOVED            = -118
+
+# connection states
+EXPIRED_SESSION_STATE   = -112
+AUTH_FAILED_STATE       = -113
+CONNECTING_STATE        = 1
+ASSOCIATING_STATE       = 2
+CONNECTED_STATE         = 3
+
+# event types
+CREATED_EVENT           = 1
+DELETED_EVENT           = 2
+CHANGED_EVENT           = 3
+CHILD_EVENT             = 4
+SESSION_EVENT           = -1
+NOTWATCHING_EVENT       = -2
+
+# node creation flags
+EPHEMERAL               = 1
+SEQUENCE                = 2
+
+# permissions
+PERM_READ               = 1
+PERM_WRITE              = 2
+PERM_CREATE             = 4
+PERM_DELETE             = 8
+PERM_ADMIN              = 16
+PERM_ALL                = 31
+
+# log levels
+LOG_LEVEL_ERROR         = 1
+LOG_LEVEL_WARN          = 2
+LOG_LEVEL_INFO          = 3
+LOG_LEVEL_DEBUG         = 4
+
+_CONSTANT_NAMES = [name for name in dir() if name.isupper() and not name.startswith('_')]
+
+# return code -> (exception name, message)
+_ERRORS = {
+    SYSTEMERROR             : ('SystemErrorException', 'system error'),
+    RUNTIMEINCONSISTENCY    : ('RuntimeInconsistencyException', 'run time inconsistency'),
+    DATAINCONSISTENCY       : ('DataInconsistencyException', 'data inconsistency'),
+    CONNECTIONLOSS          : ('ConnectionLossException', 'connection loss'),
+    MARSHALLINGERROR        : ('MarshallingErrorException', 'marshalling error'),
+    UNIMPLEMENTED           : ('UnimplementedException', 'unimplemented'),
+    OPERATIONTIMEOUT        : ('OperationTimeoutException', 'operation timeout'),
+    BADARGUMENTS            : ('BadArgumentsException', 'bad arguments'),
+    INVALIDSTATE            : ('InvalidStateException', 'invalid zhandle state'),
+    APIERROR                : ('ApiErrorException', 'api error'),
+    NONODE                  : ('NoNodeException', 'no node'),
+    NOAUTH                  : ('NoAuthException', 'not authenticated'),
+    BADVERSION              : ('BadVersionException', 'bad version'),
+    NOCHILDRENFOREPHEMERALS : ('NoChildrenForEphemeralsException', 'no children for ephemerals'),
+    NODEEXISTS              : ('NodeExistsException', 'node exists'),
+    NOTEMPTY                : ('NotEmptyException', 'not empty'),
+    SESSIONEXPIRED          : ('SessionExpiredException', 'session expired'),
+    INVALIDCALLBACK         : ('InvalidCallbackException', 'invalid callback'),
+    INVALIDACL              : ('InvalidACLException', 'invalid acl'),
+    AUTHFAILED              : ('AuthFailedException', 'authentication failed'),
+    CLOSING                 : ('ClosingException', 'zookeeper is closing'),
+    NOTHING                 : ('NothingException', '(not error) no server responses to process'),
+    SESSIONMOVED            : ('SessionMovedException', 'session moved to another server, so operation is ignored'),
+}
+
+
+def _exception_types():
+    '''Returns the zookeeper exception types by name. The types of the C
+    binding are used if it is installed, thus zkpy code catching
+    zookeeper.NoNodeException works with both backends.
+    '''
+    if _zookeeper is not None:
+        base = _zookeeper.ZooKeeperException
+    else:
+        base = type('ZooKeeperException', (Exception,), {'__module__' : 'zookeeper'})
+    types = {'ZooKeeperException' : base}
+    for name, _message in _ERRORS.itervalues():
+        exception_type = getattr(_zookeeper, name, None)
+        if exception_type is None:
+            exception_type = type(name, (base,), {'__module__' : 'zookeeper'})
+        types[name] = exception_type
+    return types
+
+_EXCEPTION_TYPES = _exception_types()
+
+
+class _Node(object):
+    '''A znode of the in-memory tree'''
+    __slots__ = ['data', 'acl', 'children', 'czxid', 'mzxid', 'pzxid',
+                 'ctime', 'mtime', 'version', 'cversion', 'aversion',
+                 'ephemeral_owner']
+
+    def __init__(self, data, acl, zxid, ephemeral_owner = 0):
+        now = int(time.time() * 1000)
+        self.data = data
+        self.acl = acl
+        self.children = set()
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = now
+        self.version = self.cversion = self.aversion = 0
+        self.ephemeral_owner = ephemeral_owner
+
+    def stat(self):
+        return {'czxid'             : self.czxid,
+                'mzxid'             : self.mzxid,
+                'ctime'             : self.ctime,
+                'mtime'             : self.mtime,
+                'version'           : self.version,
+                'cversion'          : self.cversion,
+                'aversion'          : self.aversion,
+                'ephemeralOwner'    : self.ephemeral_owner,
+                'dataLength'        : len(self.data),
+                'numChildren'       : len(self.children),
+                'pzxid'             : self.pzxid}
+
+
+class _Session(object):
+    '''Client session. Delivers completions and watch events in order on its
+    own thread, like the completion thread of the C client.
+    '''
+
+    def __init__(self, handle, session_id, watcher, timeout):
+        self.handle = handle
+        self.session_id = session_id
+        self.password = '%016x' % random.getrandbits(64)
+        self.watcher = watcher
+        self.timeout = timeout
+        self.state = CONNECTING_STATE
+        self.ephemerals = set()
+        self.closed = False
+        # (watcher, type, path) of the watches fired while disconnected
+        self.missed = []
+
+        self._queue = deque()
+        self._last_due = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run,
+                                        name='zkpy-fake-session-%d' % handle)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def schedule(self, delay, function, *args):
+        '''Calls function(*args) on the session thread after delay seconds.
+        Calls are executed in the order of scheduling.
+        '''
+        self._condition.acquire()
+        try:
+            due = max(time.time() + delay, self._last_due)
+            self._last_due = due
+            self._queue.append((due, function, args))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def stop(self):
+        '''Stops the session thread. Pending callbacks are dropped.'''
+        self._condition.acquire()
+        try:
+            self.closed = True
+            self._queue.clear()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while True:
+                    if self._queue:
+                        due, function, args = self._queue[0]
+                        remaining = due - time.time()
+                        if remaining <= 0:
+                            self._queue.popleft()
+                            break
+                        self._condition.wait(remaining)
+                    elif self.closed:
+                        return
+                    else:
+                        self._condition.wait()
+            finally:
+                self._condition.release()
+
+            try:
+                function(*args)
+            except Exception:
+                logger.exception('Callback %s of session %d failed' % (function, self.handle))
+
+
+class FakeZookeeper(object):
+    '''In-memory zookeeper ensemble with the call surface of the zookeeper
+    module.
+
+    Supports persistent, ephemeral and sequential nodes, versions, data and
+    child watches, sessions, disconnects and session expiry. Every request
+    takes latency seconds plus a random jitter (synchronous calls block for
+    that time, asynchronous calls complete after it). A fraction of the
+    requests can be failed with a ConnectionLossException.
+    Request counts are tracked in the counters dict, the number of children
+    returned by get_children() in its 'listed_children' entry.
+    '''
+
+    def __init__(self, latency = 0.0, jitter = 0.0, connection_loss = 0.0, seed = None):
+        '''
+        :param latency: round trip time of a request in seconds
+        :param jitter: maximal random delay added to the latency (seconds)
+        :param connection_loss: probability, that a request fails with a
+                                connection loss (it is not executed)
+        :param seed: seed of the random generator (jitter, connection loss)
+        '''
+        self.latency = latency
+        self.jitter = jitter
+        self.connection_loss = connection_loss
+        self.counters = {}
+
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._zxid = 0
+        self._nodes = {'/' : _Node('', [], 0)}
+        self._data_watches = {}
+        self._child_watches = {}
+        self._sessions = {}
+        self._next_handle = 0
+        self._next_session_id = 0x12b00000000
+
+        # the zookeeper module's constants and exceptions
+        for name in _CONSTANT_NAMES:
+            setattr(self, name, globals()[name])
+        for name, exception_type in _EXCEPTION_TYPES.iteritems():
+            setattr(self, name, exception_type)
+
+        self._nodes['/'].children.add('zookeeper')
+        self._nodes['/zookeeper'] = _Node('', [], 0)
+
+    ###########################################################################
+    # fault injection
+
+    def disconnect(self, handle):
+        '''Simulates a lost server connection. Requests fail with a
+        ConnectionLossException until reconnect() is called.
+        '''
+        self._set_state(self._session(handle), CONNECTING_STATE)
+
+    def reconnect(self, handle):
+        '''Reestablishes a connection broken by disconnect(). Watches, which
+        fired in between, are delivered after the session event, like the
+        client does, when it sets its watches again.
+        '''
+        session = self._session(handle)
+        self._lock.acquire()
+        try:
+            self._set_state(session, CONNECTED_STATE)
+            missed, session.missed = session.missed, []
+        finally:
+            self._lock.release()
+        for watcher, event_type, path in missed:
+            session.schedule(self.latency / 2., watcher, handle, event_type,
+                             CONNECTED_STATE, path)
+
+    def expire_session(self, handle):
+        '''Expires a session: its ephemeral nodes are deleted and its watchers
+        get an expiration event.
+        '''
+        session = self._session(handle)
+        self._lock.acquire()
+        try:
+            self._set_state(session, EXPIRED_SESSION_STATE)
+            del session.missed[:]
+            self._delete_ephemerals(session)
+            self._drop_watches(handle)
+        finally:
+            self._lock.release()
+
+    ###########################################################################
+    # internals
+
+    def _count(self, name, increment = 1):
+        self.counters[name] = self.counters.get(name, 0) + increment
+
+    def _delay(self):
+        '''Returns the duration of the next request'''
+        if self.jitter:
+            return self.latency + self._random.uniform(0, self.jitter)
+        return self.latency
+
+    def _error(self, rc):
+        name, message = _ERRORS[rc]
+        exception = _EXCEPTION_TYPES[name](message)
+        exception.rc = rc
+        return exception
+
+    def _session(self, handle):
+        try:
+            return self._sessions[handle]
+        except KeyError:
+            raise _EXCEPTION_TYPES['ZooKeeperException']('zhandle already freed')
+
+    def _check_session(self, session):
+        '''Raises the exception a request of the session would fail with'''
+        if session.state == EXPIRED_SESSION_STATE:
+            raise self._error(SESSIONEXPIRED)
+        if session.state != CONNECTED_STATE:
+            raise self._error(CONNECTIONLOSS)
+        if self.connection_loss and self._random.random() < self.connection_loss:
+            raise self._error(CONNECTIONLOSS)
+
+    def _set_state(self, session, state):
+        '''Changes the session state and notifies the session's watchers'''
+        self._lock.acquire()
+        try:
+            session.state = state
+            watchers = [session.watcher]
+            for watches in (self._data_watches, self._child_watches):
+                for path_watches in watches.itervalues():
+                    watchers.extend(watcher for watch_handle, watcher in path_watches
+                                    if watch_handle == session.handle)
+        finally:
+            self._lock.release()
+        for watcher in watchers:
+            if watcher is not None:
+                session.schedule(0, watcher, session.handle, SESSION_EVENT, state, '')
+
+    def _drop_watches(self, handle):
+        for watches in (self._data_watches, self._child_watches):
+            for path, path_watches in watches.items():
+                remaining = set(watch for watch in path_watches if watch[0] != handle)
+                if remaining:
+                    watches[path] = remaining
+                else:
+                    del watches[path]
+
+    def _delete_ephemerals(self, session):
+        for path in sorted(session.ephemerals, reverse=True):
+            if path in self._nodes:
+                self._delete(path, -1)
+        session.ephemerals.clear()
+
+    def _add_watch(self, watches, handle, path, watcher):
+        if watcher is not None:
+            watches.setdefault(path, set()).add((handle, watcher))
+
+    def _trigger(self, watches, path, event_type):
+        '''Fires and removes the watches of a path'''
+        for handle, watcher in watches.pop(path, ()):
+            session = self._sessions.get(handle)
+            if session is None:
+                continue
+            if session.state == CONNECTED_STATE:
+                session.schedule(self.latency / 2., watcher, handle, event_type,
+                                 CONNECTED_STATE, path)
+            elif session.state == CONNECTING_STATE:
+                # delivered by reconnect()
+                session.missed.append((watcher, event_type, path))
+
+    def _validate_path(self, path):
+        if (not isinstance(path, basestring) or not path.startswith('/')
+            or (path != '/' and path.endswith('/')) or '//' in path):
+            raise self._error(BADARGUMENTS)
+
+    def _parent(self, path):
+        return path[:path.rfind('/')] or '/'
+
+    def _node(self, path):
+        self._validate_path(path)
+        try:
+            return self._nodes[path]
+        except KeyError:
+            raise self._error(NONODE)
+
+    def _next_zxid(self):
+        self._zxid += 1
+        return self._zxid
+
+    def _create(self, session, path, data, acl, flags):
+        self._validate_path(path)
+        if path == '/':
+            raise self._error(NODEEXISTS)
+        parent_path = self._parent(path)
+        parent = self._nodes.get(parent_path)
+        if parent is None:
+            raise self._error(NONODE)
+        if parent.ephemeral_owner:
+            raise self._error(NOCHILDRENFOREPHEMERALS)
+        if flags & SEQUENCE:
+            path = '%s%010d' % (path, parent.cversion)
+        if path in self._nodes:
+            raise self._error(NODEEXISTS)
+
+        zxid = self._next_zxid()
+        owner = 0
+        if flags & EPHEMERAL:
+            owner = session.session_id
+            session.ephemerals.add(path)
+        self._nodes[path] = _Node(data or '', acl, zxid, owner)
+        parent.children.add(path[path.rfind('/') + 1:])
+        parent.cversion += 1
+        parent.pzxid = zxid
+
+        self._trigger(self._data_watches, path, CREATED_EVENT)
+        self._trigger(self._child_watches, parent_path, CHILD_EVENT)
+        return path
+
+    def _delete(self, path, version):
+        node = self._node(path)
+        if path == '/':
+            raise self._error(BADARGUMENTS)
+        if version != -1 and version != node.version:
+            raise self._error(BADVERSION)
+        if node.children:
+            raise self._error(NOTEMPTY)
+
+        parent_path = self._parent(path)
+        parent = self._nodes[parent_path]
+        del self._nodes[path]
+        parent.children.discard(path[path.rfind('/') + 1:])
+        parent.cversion += 1
+        parent.pzxid = self._next_zxid()
+        if node.ephemeral_owner:
+            for session in self._sessions.itervalues():
+                session.ephemerals.discard(path)
+
+        self._trigger(self._data_watches, path, DELETED_EVENT)
+        self._trigger(self._child_watches, path, DELETED_EVENT)
+        self._trigger(self._child_watches, parent_path, CHILD_EVENT)
+        return OK
+
+    def _set(self, path, data, version):
+        node = self._node(path)
+        if version != -1 and version != node.version:
+            raise self._error(BADVERSION)
+        node.data = data or ''
+        node.version += 1
+        node.mzxid = self._next_zxid()
+        node.mtime = int(time.time() * 1000)
+        self._trigger(self._data_watches, path, CHANGED_EVENT)
+        return node.stat()
+
+    def _exists(self, handle, path, watcher):
+        self._validate_path(path)
+        self._add_watch(self._data_watches, handle, path, watcher)
+        node = self._nodes.get(path)
+        if node is None:
+            return None
+        return node.stat()
+
+    def _get(self, handle, path, watcher):
+        node = self._node(path)
+        self._add_watch(self._data_watches, handle, path, watcher)
+        return node.data, node.stat()
+
+    def _get_children(self, handle, path, watcher):
+        node = self._node(path)
+        self._add_watch(self._child_watches, handle, path, watcher)
+        self._count('listed_children', len(node.children))
+        return list(node.children)
+
+    def _execute(self, handle, name, operation, *args):
+        '''Executes a request of a session synchronously'''
+        session = self._session(handle)
+        delay = self._delay()
+        if delay:
+            time.sleep(delay / 2.)
+        self._lock.acquire()
+        try:
+            self._count(name)
+            self._check_session(session)
+            result = operation(*args)
+        finally:
+            self._lock.release()
+        if delay:
+            time.sleep(delay / 2.)
+        return result
+
+    def _execute_async(self, handle, name, completion, operation, *args):
+        '''Executes a request of a session and calls
+        completion(handle, rc, *result) on the session thread.
+        '''
+        session = self._session(handle)
+        self._lock.acquire()
+        try:
+            self._count(name)
+            try:
+                self._check_session(session)
+                result = operation(*args)
+                rc = OK
+            except _EXCEPTION_TYPES['ZooKeeperException'] as e:
+                result = None
+                rc = getattr(e, 'rc', SYSTEMERROR)
+        finally:
+            self._lock.release()
+        if completion is not None:
+            session.schedule(self._delay(), completion, handle, rc, result)
+        return OK
+
+    ###########################################################################
+    # zookeeper module calls
+
+    def set_debug_level(self, level):
+        pass
+
+    def set_log_stream(self, stream):
+        pass
+
+    def deterministic_conn_order(self, yes_or_no):
+        pass
+
+    def zerror(self, rc):
+        if rc == OK:
+            return 'ok'
+        try:
+            return _ERRORS[rc][1]
+        except KeyError:
+            return 'unknown error'
+
+    def init(self, host, watcher = None, recv_timeout = 10000, client_id = None):
+        self._lock.acquire()
+        try:
+            handle = self._next_handle
+            self._next_handle += 1
+            if client_id is not None and client_id[0] in [session.session_id for session in self._sessions.itervalues()]:
+                session_id = client_id[0]
+            else:
+                session_id = self._next_session_id
+                self._next_session_id += 1
+            session = _Session(handle, session_id, watcher, recv_timeout)
+            self._sessions[handle] = session
+        finally:
+            self._lock.release()
+        session.state = CONNECTED_STATE
+        if watcher is not None:
+            session.schedule(self._delay(), watcher, handle, SESSION_EVENT, CONNECTED_STATE, '')
+        return handle
+
+    def close(self, handle):
+        session = self._session(handle)
+        self._lock.acquire()
+        try:
+            if session.state != EXPIRED_SESSION_STATE:
+                # closed sessions get no more watch events
+                session.state = 0
+                self._delete_ephemerals(session)
+            self._drop_watches(handle)
+            del self._sessions[handle]
+        finally:
+            self._lock.release()
+        session.stop()
+        return OK
+
+    def state(self, handle):
+        return self._session(handle).state
+
+    def client_id(self, handle):
+        session = self._session(handle)
+        return session.session_id, session.password
+
+    def recv_timeout(self, handle):
+        return self._session(handle).timeout
+
+    def is_unrecoverable(self, handle):
+        return self._session(handle).state == EXPIRED_SESSION_STATE
+
+    def set_watcher(self, handle, watcher):
+        self._session(handle).watcher = watcher
+
+    def add_auth(self, handle, scheme, credentials, completion = None):
+        session = self._session(handle)
+        if completion is not None:
+            session.schedule(self._delay(), completion, handle, OK)
+        return OK
+
+    def create(self, handle, path, data, acl, flags = 0):
+        session = self._session(handle)
+        return self._execute(handle, 'create', self._create, session, path, data, acl, flags)
+
+    def delete(self, handle, path, version = -1):
+        return self._execute(handle, 'delete', self._delete, path, version)
+
+    def set(self, handle, path, data, version = -1):
+        self._execute(handle, 'set', self._set, path, data, version)
+        return OK
+
+    def set2(self, handle, path, data, version = -1):
+        return self._execute(handle, 'set', self._set, path, data, version)
+
+    def exists(self, handle, path, watcher = None):
+        return self._execute(handle, 'exists', self._exists, handle, path, watcher)
+
+    def get(self, handle, path, watcher = None, bufferlen = None):
+        return self._execute(handle, 'get', self._get, handle, path, watcher)
+
+    def get_children(self, handle, path, watcher = None):
+        return self._execute(handle, 'get_children', self._get_children, handle, path, watcher)
+
+    def get_acl(self, handle, path):
+        def get_acl():
+            node = self._node(path)
+            return node.stat(), list(node.acl)
+        return self._execute(handle, 'get_acl', get_acl)
+
+    def set_acl(self, handle, path, version, acl):
+        def set_acl():
+            node = self._node(path)
+            if version != -1 and version != node.aversion:
+                raise self._error(BADVERSION)
+            node.acl = acl
+            node.aversion += 1
+            return OK
+        return self._execute(handle, 'set_acl', set_acl)
+
+    def acreate(self, handle, path, data, acl, flags = 0, completion = None):
+        session = self._session(handle)
+        def create_completion(handle, rc, path):
+            completion(handle, rc, path)
+        return self._execute_async(handle, 'create', completion and create_completion,
+                                   self._create, session, path, data, acl, flags)
+
+    def adelete(self, handle, path, version = -1, completion = None):
+        def delete_completion(handle, rc, _result):
+            completion(handle, rc)
+        return self._execute_async(handle, 'delete', completion and delete_completion,
+                                   self._delete, path, version)
+
+    def aset(self, handle, path, data, version = -1, completion = None):
+        return self._execute_async(handle, 'set', completion,
+                                   self._set, path, data, version)
+
+    def aexists(self, handle, path, watcher = None, completion = None):
+        def exists_completion(handle, rc, stat):
+            if rc == OK and stat is None:
+                rc = NONODE
+            completion(handle, rc, stat)
+        return self._execute_async(handle, 'exists', completion and exists_completion,
+                                   self._exists, handle, path, watcher)
+
+    def aget(self, handle, path, watcher = None, completion = None):
+        def get_completion(handle, rc, result):
+            data, stat = result or (None, None)
+            completion(handle, rc, data, stat)
+        return self._execute_async(handle, 'get', completion and get_completion,
+                                   self._get, handle, path, watcher)
+
+    def aget_children(self, handle, path, watcher = None, completion = None):
+        return self._execute_async(handle, 'get_children', completion,
+                                   self._get_children, handle, path, watcher)
+
+
+def install(fake = None):
+    '''Registers a FakeZookeeper as the zookeeper module. This allows to use
+    zkpy without the C binding. Needs to be called before zkpy.connection
+    (or any recipe) is imported.
+    Returns the installed FakeZookeeper.
+    '''
+    import zkpy
+    if fake is None:
+        fake = FakeZookeeper()
+    sys.modules['zookeeper'] = fake
+    zkpy.zookeeper = fake
+    return fake
@@ -33,3 +33,87 @@ def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), __slots__ = (), **named)
     return type('Enum', (dict,), enums)( (v,k) for k,v in enums.iteritems())
 
+
+def join_path(parent, child):
+    '''Joins a node path and a child name.
+
+        >>> join_path('/foo', 'bar')
+        '/foo/bar'
+        >>> join_path('/', 'bar')
+        '/bar'
+    '''
+    return '%s/%s' % (parent.rstrip('/'), child)
+
+
+class LRUCache(object):
+    '''Dictionary holding at most max_size entries. When full, the least
+    recently used entry is dropped. Not thread safe.
+
+        >>> cache = LRUCache(2)
+        >>> cache['a'] = 1; cache['b'] = 2
+        >>> cache.get('a')
+        1
+        >>> cache['c'] = 3
+        >>> 'b' in cache
+        False
+    '''
+
+    # link layout: [previous, next, key, value]. New entries are linked in
+    # before the root, thus root[1] is the least recently used one.
+    _PREV, _NEXT, _KEY, _VALUE = range(4)
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def _unlink(self, link):
+        link[self._PREV][self._NEXT] = link[self._NEXT]
+        link[self._NEXT][self._PREV] = link[self._PREV]
+
+    def _append(self, link):
+        last = self._root[self._PREV]
+        link[self._PREV] = last
+        link[self._NEXT] = self._root
+        last[self._NEXT] = self._root[self._PREV] = link
+
+    def get(self, key, default = None):
+        '''Returns the value of key and marks it as recently used'''
+        link = self._links.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[self._VALUE]
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            link[self._VALUE] = value
+            self._unlink(link)
+        else:
+            link = self._links[key] = [None, None, key, value]
+            if len(self._links) > self.max_size:
+                oldest = self._root[self._NEXT]
+                self._unlink(oldest)
+                del self._links[oldest[self._KEY]]
+        self._append(link)
+
+    def pop(self, key, default = None):
+        '''Removes key and returns its value'''
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[self._VALUE]
+
+    def clear(self):
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None]
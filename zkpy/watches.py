@@ -0,0 +1,392 @@
+'''
+Created on 17.10.2010
+
+@author: luk
+'''
+
+from zkpy.connection import EventType, KeeperState
+import heapq
+import logging
+import threading
+import time
+import zookeeper
+
+
+logger = logging.getLogger(__name__)
+
+# events of the data watch (exists) and of the child watch (get_children)
+_DATA_EVENTS = frozenset([EventType.NodeCreated,
+                          EventType.NodeDeleted,
+                          EventType.NodeDataChanged])
+_NODE_EVENTS = _DATA_EVENTS | frozenset([EventType.NodeChildrenChanged])
+
+def _names(path):
+    '''Path names of path, '/' has none'''
+    return [name for name in path.split('/') if name]
+
+
+class Subscription(object):
+    '''Subscription of a callback to the events of a path.
+    Returned by Connection.subscribe(), cancel() ends it.
+    '''
+
+    def __init__(self, registry, path, callback, types, prefix, coalesce = None):
+        self.path = path
+        self.callback = callback
+        self.types = types
+        self.prefix = prefix
+        self.coalesce = coalesce
+        self._registry = registry
+
+    def __repr__(self):
+        return '<Subscription %s%s %s>' % (self.path, self.prefix and '*' or '',
+                                           self.callback)
+
+    def wants(self, type):
+        '''Returns True, if the subscription receives events of this type'''
+        return self.types is None or type in self.types
+
+    def cancel(self):
+        '''Stops delivering events to the callback'''
+        self._registry.unsubscribe(self)
+
+
+class WatchRegistry(object):
+    '''Dispatches the events of a connection to the subscribers of their path.
+    Subscriptions of a path are kept in a dict, subscriptions of a prefix in a
+    trie of path names. An event thus costs one dict lookup plus one per level
+    of its path, and only the interested subscribers are called.
+
+    The registry sets one watch per path on the server, no matter how many
+    subscribers it has: a data watch (exists) and a child watch
+    (get_children), if child events are subscribed. Fired watches are set
+    again before the subscribers are called, as long as the path has
+    subscribers. Watches which could not be set are retried, once the
+    connection is back.
+
+    Prefix subscriptions do not set watches. They receive the events of the
+    paths below and at the prefix, which are watched by an exact subscription
+    of the registry, and all session events. Session events have the empty
+    path ''.
+
+    Coalescing subscriptions receive a single event per path and time window,
+    the last one of the types they subscribed to. The window starts with the
+    first event of a path. If all subscribers of a path and of its prefixes
+    coalesce, its watches are set again only when the window ends: the server
+    sends no events in between, and a subscriber reading the node on its
+    callback reads once per burst of changes.
+    '''
+
+    def __init__(self, connection):
+        '''Registry construction.
+        :param connection: The zkpy connection
+        '''
+        self._connection = connection
+        self._lock = threading.Lock()
+        # path -> tuple of subscriptions. Tuples are replaced on changes, so
+        # that events are dispatched without locking.
+        self._exact = {}
+        # trie node: [children by name, tuple of subscriptions]
+        self._prefixes = [{}, ()]
+        # paths with a data/child watch set on the server
+        self._data_watched = set()
+        self._child_watched = set()
+        # path -> [(type, state)] of the events coalesced in its window, the
+        # last event of each type only. Windows end in order of the heap.
+        self._pending = {}
+        self._deadlines = []
+        self._window_ended = threading.Condition(self._lock)
+        self._flusher = None
+        self._closed = False
+
+    def subscribe(self, path, callback, types = None, prefix = False,
+                  coalesce = None):
+        '''Calls callback(type, state, path) for the events of path.
+        :param path: Node path, '' for session events
+        :param callback: Called with the event type, the state and the path
+        :param types: Iterable of EventType values to deliver, None for all
+        :param prefix: If True, the events of all nodes below path are
+                       delivered as well
+        :param coalesce: Time window in seconds. Node events of a path are
+                         delivered once per window, None delivers each.
+        :returns: Subscription
+        '''
+        if types is not None:
+            types = frozenset(types)
+        if path != '/':
+            path = path.rstrip('/')
+        subscription = Subscription(self, path, callback, types, prefix, coalesce)
+        self._lock.acquire()
+        try:
+            if prefix:
+                node = self._prefixes
+                for name in _names(path):
+                    node = node[0].setdefault(name, [{}, ()])
+                node[1] = node[1] + (subscription,)
+            else:
+                self._exact[path] = self._exact.get(path, ()) + (subscription,)
+        finally:
+            self._lock.release()
+        if not prefix:
+            self._watch(path)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        '''Removes a subscription. Watches which are set already stay on the
+        server, but are not set again when they fire.
+        '''
+        self._lock.acquire()
+        try:
+            if subscription.prefix:
+                node = self._prefixes
+                trail = []
+                for name in _names(subscription.path):
+                    trail.append((node, name))
+                    node = node[0].get(name)
+                    if node is None:
+                        return
+                node[1] = tuple(registered for registered in node[1]
+                                if registered is not subscription)
+                # prune the branch, if nothing is left below it
+                while trail and not node[0] and not node[1]:
+                    parent, name = trail.pop()
+                    del parent[0][name]
+                    node = parent
+            else:
+                subscriptions = tuple(registered for registered
+                                      in self._exact.get(subscription.path, ())
+                                      if registered is not subscription)
+                if subscriptions:
+                    self._exact[subscription.path] = subscriptions
+                else:
+                    self._exact.pop(subscription.path, None)
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        '''Number of paths with subscriptions'''
+        return len(self._exact)
+
+    def close(self):
+        '''Stops delivering coalesced events'''
+        self._lock.acquire()
+        try:
+            self._closed = True
+            self._pending.clear()
+            del self._deadlines[:]
+            self._window_ended.notify()
+        finally:
+            self._lock.release()
+
+    def _subscriptions(self, path):
+        '''Yields the subscriptions of path and of its prefixes. Session
+        events go to all prefix subscriptions.
+        '''
+        for subscription in self._exact.get(path, ()):
+            yield subscription
+        if not path:
+            nodes = [self._prefixes]
+            while nodes:
+                node = nodes.pop()
+                for subscription in node[1]:
+                    yield subscription
+                nodes.extend(node[0].itervalues())
+            return
+        node = self._prefixes
+        names = _names(path)
+        index = 0
+        while node is not None:
+            for subscription in node[1]:
+                yield subscription
+            if index == len(names):
+                break
+            node = node[0].get(names[index])
+            index += 1
+
+    def dispatch(self, type, state, path):
+        '''Calls the subscribers of an event'''
+        if type == EventType.NoneType:
+            if state == KeeperState.Expired:
+                # the watches went away with the session
+                self._lock.acquire()
+                try:
+                    self._data_watched.clear()
+                    self._child_watched.clear()
+                finally:
+                    self._lock.release()
+            elif state == KeeperState.Connected:
+                for watched_path in list(self._exact):
+                    self._watch(watched_path)
+
+        window = None
+        for subscription in self._subscriptions(path):
+            if not subscription.wants(type):
+                continue
+            if subscription.coalesce is None or type == EventType.NoneType:
+                try:
+                    subscription.callback(type, state, path)
+                except Exception:
+                    logger.exception('Subscriber %s failed' % subscription)
+            elif window is None or subscription.coalesce < window:
+                window = subscription.coalesce
+        if window is not None:
+            self._coalesce(type, state, path, window)
+
+    def _coalesce(self, type, state, path, window):
+        '''Adds an event to the window of its path'''
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            events = self._pending.get(path)
+            if events is None:
+                self._pending[path] = [(type, state)]
+                heapq.heappush(self._deadlines, (time.time() + window, path))
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_windows,
+                                                     name='zkpy-coalesce')
+                    self._flusher.setDaemon(True)
+                    self._flusher.start()
+                self._window_ended.notify()
+            else:
+                events[:] = [event for event in events if event[0] != type]
+                events.append((type, state))
+        finally:
+            self._lock.release()
+
+    def _flush_windows(self):
+        '''Delivers the coalesced events, when their window ended'''
+        self._lock.acquire()
+        try:
+            while not self._closed:
+                if not self._deadlines:
+                    self._window_ended.wait()
+                    continue
+                deadline, path = self._deadlines[0]
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self._window_ended.wait(remaining)
+                    continue
+                heapq.heappop(self._deadlines)
+                events = self._pending.pop(path)
+                self._lock.release()
+                try:
+                    self._flush(path, events)
+                finally:
+                    self._lock.acquire()
+        finally:
+            self._lock.release()
+
+    def _flush(self, path, events):
+        # watches deferred during the window are set before the callbacks,
+        # which may read the node
+        self._watch(path)
+        executor = self._connection._executor
+        if executor is not None:
+            executor.submit(self._connection._dispatch_key(path),
+                            self._deliver, path, events)
+        else:
+            self._deliver(path, events)
+
+    def _deliver(self, path, events):
+        '''Calls the coalescing subscribers with the last event they want'''
+        for subscription in self._subscriptions(path):
+            if subscription.coalesce is None:
+                continue
+            for type, state in reversed(events):
+                if subscription.wants(type):
+                    try:
+                        subscription.callback(type, state, path)
+                    except Exception:
+                        logger.exception('Subscriber %s failed' % subscription)
+                    break
+
+    def _deferred(self, path):
+        '''Returns True, if all subscribers of path coalesce, those of its
+        prefixes included. Its watches are set again, when the window ends.
+        '''
+        if not self._exact.get(path):
+            return False
+        for subscription in self._subscriptions(path):
+            if subscription.coalesce is None and (subscription.types is None or
+                                                  subscription.types & _NODE_EVENTS):
+                return False
+        return True
+
+    def _watch(self, path):
+        '''Sets the missing watches of a subscribed path'''
+        if not path:
+            return
+        self._lock.acquire()
+        try:
+            wants_data = wants_child = False
+            for subscription in self._exact.get(path, ()):
+                if subscription.types is None or subscription.types & _NODE_EVENTS:
+                    # the data watch tells about the node's creation as well
+                    wants_data = True
+                    wants_child = (wants_child or
+                                   subscription.wants(EventType.NodeChildrenChanged))
+            set_data = wants_data and path not in self._data_watched
+            set_child = wants_child and path not in self._child_watched
+            if set_data:
+                self._data_watched.add(path)
+            if set_child:
+                self._child_watched.add(path)
+        finally:
+            self._lock.release()
+
+        if set_data:
+            future = self._connection.exists_async(path, self._data_watcher)
+            future.add_done_callback(
+                lambda future: self._watch_done(future, path, self._data_watched))
+        if set_child:
+            future = self._connection.get_children_async(path, self._child_watcher)
+            future.add_done_callback(
+                lambda future: self._watch_done(future, path, self._child_watched))
+
+    def _watch_done(self, future, path, watched):
+        exception = future.exception()
+        if exception is None:
+            return
+        self._lock.acquire()
+        try:
+            watched.discard(path)
+        finally:
+            self._lock.release()
+        # a missing node is seen by the data watch, when it is created
+        if not isinstance(exception, zookeeper.NoNodeException):
+            logger.warn('Could not watch %s: %s' % (path, exception))
+
+    def _data_watcher(self, handle, type, state, path):
+        # session events are delivered by the global watcher
+        if type == EventType.NoneType:
+            return
+        self._lock.acquire()
+        try:
+            self._data_watched.discard(path)
+        finally:
+            self._lock.release()
+        if not self._deferred(path):
+            self._watch(path)
+        self.dispatch(type, state, path)
+
+    def _child_watcher(self, handle, type, state, path):
+        if type == EventType.NoneType:
+            return
+        self._lock.acquire()
+        try:
+            self._child_watched.discard(path)
+        finally:
+            self._lock.release()
+        # deletions are delivered by the data watch
+        if type == EventType.NodeChildrenChanged:
+            if not self._deferred(path):
+                self._watch(path)
+            self.dispatch(type, state, path)
+
+
+def main():
+    pass
+
+if __name__ == '__main__':
+    main()